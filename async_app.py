@@ -0,0 +1,459 @@
+# 檔案：async_app.py
+#
+# ★★★ 非同步服務模式 (asyncio) ★★★
+#
+# 同步版 (gunicorn main:app，gthread) 每個 worker 同時只能處理 GUNICORN_THREADS 則訊息，而時間幾乎都花在等待
+# Gemini、LINE 與 Postgres。這裡改用：
+#   - aiohttp 非同步 webhook (先回 200，事件在背景 task 處理，避免 LINE 因逾時重送)
+#   - LINE SDK 的 AsyncMessagingApi / AsyncMessagingApiBlob
+#   - google-genai 的 client.aio
+#   - psycopg 3 非同步連線池 + pgvector
+# 一個程序即可同時處理數百則對話，記憶體遠低於開一堆同步 worker。
+#
+# 啟動方式 (Render 的 Start Command)：
+#   gunicorn async_app:app --worker-class aiohttp.GunicornWebWorker
+# 本機：
+#   python async_app.py
+#
+# 設定、提示詞、檢索 SQL、去重 / 合併統計、紀錄佇列、背景讀書、斷路器與健康檢查狀態都直接沿用 main.py。
+
+import os
+import time
+import asyncio
+import tempfile
+
+from aiohttp import web
+from linebot.v3 import WebhookParser
+from linebot.v3.exceptions import InvalidSignatureError
+from linebot.v3.messaging import (
+    AsyncApiClient, AsyncMessagingApi, AsyncMessagingApiBlob,
+    ReplyMessageRequest, TextMessage
+)
+from linebot.v3.webhooks import (
+    MessageEvent,
+    TextMessageContent,
+    ImageMessageContent,
+    AudioMessageContent
+)
+from google.genai import types
+import psycopg
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
+from pgvector.psycopg import register_vector_async
+
+# 健康檢查改由這裡的非同步版本執行 (量測的是非同步連線池與 AsyncApiClient)
+os.environ.setdefault('HEALTH_CHECKS', '0')
+import main
+from vector_storage import ITERATIVE_SCAN_SQL, build_search_query
+
+parser = WebhookParser(main.CHANNEL_SECRET)
+
+# ==========================================
+# [非同步] Gemini / Postgres
+# ==========================================
+async def get_embedding(text):
+    """取得向量 (非同步版，重試與斷路邏輯與 main.get_embedding 相同)"""
+    for _ in range(3):
+        try:
+            response = await main.gemini_breaker.call_async(
+                main.gemini_client.aio.models.embed_content,
+                model=main.EMBEDDING_MODEL,
+                contents=text
+            )
+            return response.embeddings[0].values
+        except main.CircuitOpenError:
+            return None
+        except Exception as e:
+            print(f"Embedding 錯誤: {e}")
+            await asyncio.sleep(1)
+    return None
+
+# 與 main.DB_FAILURES 對應：連線失敗、斷線、查詢逾時 (QueryCanceled 屬於 OperationalError) 與連線池等待逾時
+DB_FAILURES = (psycopg.OperationalError, psycopg.InterfaceError, PoolTimeout)
+
+async def run_db(pool, work):
+    """
+    從連線池取得連線執行 work(conn)，計入 main.db_breaker 的方式與 main.pooled_connection 相同：
+    連線 / 逾時類錯誤記為失敗；資料庫有正常回應 (含 SQL 錯誤) 記為成功；
+    其他例外 (程式錯誤、task 被取消) 不計結果，只歸還試探名額。
+    壞掉的連線由 psycopg_pool 歸還時自行丟棄。
+    """
+    if not main.db_breaker.allow():
+        raise main.CircuitOpenError(f"{main.db_breaker.name} 斷路中")
+    try:
+        async with pool.connection(timeout=main.DB_CONNECT_TIMEOUT) as conn:
+            result = await work(conn)
+    except DB_FAILURES:
+        main.db_breaker.record(False)
+        raise
+    except psycopg.Error:
+        main.db_breaker.record(True)
+        raise
+    except BaseException:
+        main.db_breaker.release()
+        raise
+    main.db_breaker.record(True)
+    return result
+
+async def search_by_vector(pool, vec, top_k=3, filters=None):
+    settings, sql, params = build_search_query(vec, top_k, filters=filters)
+
+    async def work(conn):
+        async with conn.cursor() as cur:
+            if filters:
+                try:
+                    await cur.execute(ITERATIVE_SCAN_SQL)
+                except psycopg.Error:
+                    await conn.rollback()
+            for statement in settings:
+                await cur.execute(statement)
+            await cur.execute(sql, params)
+            return await cur.fetchall()
+    return await run_db(pool, work)
+
+async def retrieve_materials(pool, query, top_k=3, filters=None):
+    """與 main.retrieve_materials 相同：資料庫斷路或查詢失敗時不引用教材"""
+    if main.db_breaker.is_open:
+        return []
+    vec = await get_embedding(query)
+    if not vec: return []
+    try:
+        rows = await search_by_vector(pool, vec, top_k, filters)
+        if filters and not rows:
+            rows = await search_by_vector(pool, vec, top_k)
+    except main.CircuitOpenError:
+        return []
+    except Exception as e:
+        print(f"⚠️ 教材檢索失敗，改為不引用教材回答: {e}")
+        return []
+    return rows
+
+async def get_user_filters(pool, user_id):
+    cached = main.cached_user_filters(user_id)
+    if cached is not None:
+        return cached
+
+    async def work(conn):
+        cur = await conn.execute(main.USER_FILTERS_SQL, (user_id,))
+        return await cur.fetchone()
+    try:
+        row = await run_db(pool, work)
+    except Exception as e:
+        print(f"⚠️ 讀取課程設定失敗: {e}")
+        return {}
+    return main.cache_user_filters(user_id, row)
+
+async def claim_webhook_event(pool, event):
+    """與 main.claim_webhook_event 相同：記憶體時間窗 + processed_events 表"""
+    event_id, is_redelivery = main.event_identity(event)
+    if not event_id:
+        return True
+
+    async def work(conn):
+        cur = await conn.execute(main.CLAIM_EVENT_SQL, (event_id,))
+        if main.dedupe_stats["claimed"] % main.EVENT_DB_CLEANUP_EVERY == 0:
+            await conn.execute(main.CLEANUP_EVENTS_SQL, (main.EVENT_DEDUPE_WINDOW,))
+        return cur.rowcount == 1
+
+    claimed = main._claim_event_in_memory(event_id, time.time())
+    if claimed:
+        try:
+            claimed = await run_db(pool, work)
+        except Exception as e:
+            print(f"⚠️ 事件去重查詢失敗: {e}")
+
+    if not claimed:
+        main.record_duplicate_event(event_id, is_redelivery)
+        return False
+    main.dedupe_stats["claimed"] += 1
+    return True
+
+# ==========================================
+# [非同步] 相同問題合併處理 (統計與 main 共用)
+# ==========================================
+_inflight = {}
+
+async def coalesce(key, compute):
+    """相同 key 同時只 await 一次 compute()，其餘 task 共用結果"""
+    entry = _inflight.get(key)
+    if entry is not None:
+        entry[1] += 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(entry[0]), main.COALESCE_WAIT_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"⚠️ 合併請求等待逾時，改為獨立計算: {key[:40]}")
+        except asyncio.CancelledError:
+            if not entry[0].cancelled():
+                raise
+        return await compute()
+
+    future = asyncio.get_running_loop().create_future()
+    entry = _inflight[key] = [future, 0]
+    try:
+        result = await compute()
+        future.set_result(result)
+        return result
+    except Exception as e:
+        future.set_exception(e)
+        if not entry[1]:
+            future.exception()  # 沒有跟隨者時標記為已讀取，避免 asyncio 警告
+        raise
+    finally:
+        if not future.done():
+            future.cancel()
+        _inflight.pop(key, None)
+        with main._inflight_lock:
+            main._record_fanout(key, entry[1])
+
+# ==========================================
+# [非同步] 對話處理
+# ==========================================
+async def answer_text_question(pool, text, filters=None, history="", materials=None):
+    """與 main.answer_text_question 相同：回傳 (回答, 引用的教材)"""
+    if materials is None:
+        materials = await retrieve_materials(pool, text, filters=filters)
+    prompt = main.build_text_prompt(text, main.format_knowledge(materials), history)
+    response = await main.gemini_breaker.call_async(
+        main.gemini_client.aio.models.generate_content,
+        model=main.TEXT_MODEL,
+        contents=prompt
+    )
+    return response.text, materials
+
+async def answer_image_question(img_data):
+    image_part = types.Part.from_bytes(data=img_data, mime_type="image/jpeg")
+    response = await main.gemini_breaker.call_async(
+        main.gemini_client.aio.models.generate_content,
+        model=main.IMAGE_MODEL,
+        contents=[main.IMAGE_PROMPT, image_part]
+    )
+    return response.text
+
+async def answer_audio_question(audio_data):
+    with tempfile.NamedTemporaryFile(suffix='.m4a', delete=False) as temp_file:
+        temp_file.write(audio_data)
+        temp_path = temp_file.name
+    try:
+        uploaded_file = await main.gemini_breaker.call_async(main.gemini_client.aio.files.upload, file=temp_path)
+        while uploaded_file.state.name == "PROCESSING":
+            await asyncio.sleep(1)
+            uploaded_file = await main.gemini_client.aio.files.get(name=uploaded_file.name)
+
+        response = await main.gemini_breaker.call_async(
+            main.gemini_client.aio.models.generate_content,
+            model=main.AUDIO_MODEL,
+            contents=[main.AUDIO_PROMPT, uploaded_file]
+        )
+        return response.text
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+async def reply(line_api, reply_token, text):
+    await line_api.reply_message(
+        ReplyMessageRequest(reply_token=reply_token, messages=[TextMessage(text=text)])
+    )
+
+async def handle_message(app, event):
+    pool = app["db_pool"]
+    line_api = app["line_api"]
+    blob_api = app["line_blob_api"]
+
+    if not await claim_webhook_event(pool, event):
+        return
+
+    user_id = event.source.user_id
+    m_type = event.message.type
+    final_response = "（思考中...）"
+    user_log_content = ""
+    turn = None
+
+    user_name = "Unknown"
+    try:
+        profile = await line_api.get_profile(user_id)
+        user_name = profile.display_name
+    except Exception: pass
+
+    try:
+        if m_type == 'text':
+            text = event.message.text
+            user_log_content = text
+
+            if text == "!status":
+                final_response = main.status_report()
+            elif text.startswith("!course"):
+                final_response = await asyncio.to_thread(main.handle_course_command, user_id, text)
+            elif text == "!new":
+                final_response = await asyncio.to_thread(main.clear_conversation, user_id)
+            else:
+                filters = await get_user_filters(pool, user_id)
+                history, materials = await asyncio.to_thread(main.conversation_context, user_id, text, filters)
+                final_response, materials = await coalesce(
+                    main.text_coalesce_key(text, filters, history),
+                    lambda: answer_text_question(pool, text, filters, history, materials)
+                )
+                turn = (text, final_response, materials, filters)
+
+        elif m_type == 'image':
+            user_log_content = "(傳送圖片)"
+            img_data = bytes(await blob_api.get_message_content(event.message.id))
+            final_response = await coalesce(
+                main.image_coalesce_key(img_data),
+                lambda: answer_image_question(img_data)
+            )
+
+        elif m_type == 'audio':
+            user_log_content = "(傳送語音)"
+            audio_data = bytes(await blob_api.get_message_content(event.message.id))
+            final_response = await answer_audio_question(audio_data)
+
+        await reply(line_api, event.reply_token, final_response)
+
+    except Exception as e:
+        main.logger.error(f"處理錯誤: {e}")
+        final_response = main.BUSY_MESSAGE
+        try:
+            await reply(line_api, event.reply_token, final_response)
+        except Exception: pass
+
+    if turn and final_response != main.BUSY_MESSAGE:
+        try:
+            await asyncio.to_thread(main.remember_turn, user_id, *turn)
+        except Exception as e:
+            print(f"⚠️ 對話記憶更新失敗: {e}")
+
+    main.log_interaction(user_id, user_name, m_type, user_log_content, final_response)
+
+# ==========================================
+# [非同步] 健康檢查與暖機 (結果寫入 main.health_state，/readyz 與 !status 共用)
+# ==========================================
+async def timed_check(coro_fn):
+    started = time.perf_counter()
+    try:
+        await coro_fn()
+        result = {"ok": True}
+    except Exception as e:
+        result = {"ok": False, "error": str(e)[:200]}
+    result["latency_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return result
+
+async def run_health_checks(app):
+    pool = app["db_pool"]
+
+    async def check_database():
+        async def work(conn):
+            await conn.execute("SELECT 1")
+        await run_db(pool, work)
+    checks = {"database": await timed_check(check_database)}
+
+    probe = {}
+    async def check_embedding():
+        response = await main.gemini_breaker.call_async(
+            main.gemini_client.aio.models.embed_content,
+            model=main.EMBEDDING_MODEL,
+            contents=main.HEALTH_PROBE_TEXT
+        )
+        probe["vec"] = response.embeddings[0].values
+    checks["embedding"] = await timed_check(check_embedding)
+
+    async def check_pgvector():
+        if "vec" not in probe:
+            raise RuntimeError("需要 Embedding 結果才能測試")
+        await search_by_vector(pool, probe["vec"], top_k=1)
+    checks["pgvector"] = await timed_check(check_pgvector)
+
+    checks["line"] = await timed_check(app["line_api"].get_bot_info)
+    main.record_health(checks)
+    return checks
+
+async def health_check_task(app):
+    while True:
+        await run_health_checks(app)
+        await asyncio.sleep(main.HEALTH_CHECK_INTERVAL)
+
+# ==========================================
+# [非同步] Webhook 與應用程式生命週期
+# ==========================================
+SUPPORTED_MESSAGES = (TextMessageContent, ImageMessageContent, AudioMessageContent)
+
+def _spawn(app, coro):
+    task = asyncio.create_task(coro)
+    app["tasks"].add(task)
+    task.add_done_callback(app["tasks"].discard)
+
+async def callback(request):
+    signature = request.headers.get('X-Line-Signature', '')
+    body = await request.text()
+    try:
+        events = parser.parse(body, signature)
+    except InvalidSignatureError:
+        raise web.HTTPBadRequest()
+
+    # 先回 200 給 LINE，實際處理在背景 task 進行
+    for event in events:
+        if isinstance(event, MessageEvent) and isinstance(event.message, SUPPORTED_MESSAGES):
+            _spawn(request.app, handle_message(request.app, event))
+    return web.Response(text='OK')
+
+async def stats(request):
+    if not main.STATS_TOKEN:
+        raise web.HTTPNotFound()
+    if request.headers.get('Authorization') != f"Bearer {main.STATS_TOKEN}":
+        raise web.HTTPForbidden()
+    try:
+        days = int(request.query.get('days', 7))
+    except ValueError:
+        days = 7
+    days = min(max(days, 1), 366)
+    return web.json_response(await asyncio.to_thread(main.get_usage_stats, days))
+
+async def healthz(request):
+    return web.json_response({"status": "ok"})
+
+async def readyz(request):
+    ready, body = main.readiness()
+    return web.json_response(body, status=200 if ready else 503)
+
+async def on_startup(app):
+    app["db_pool"] = AsyncConnectionPool(
+        main.DATABASE_URL,
+        min_size=main.DB_POOL_MIN,
+        max_size=main.DB_POOL_MAX,
+        open=False,
+        configure=register_vector_async,
+        # 不使用 prepared statement，讓 course = '...' 的查詢能對應到各課程的部分索引
+        kwargs={
+            "prepare_threshold": None,
+            "connect_timeout": main.DB_CONNECT_TIMEOUT,
+            "options": f"-c statement_timeout={main.DB_STATEMENT_TIMEOUT * 1000}",
+        },
+    )
+    await app["db_pool"].open()
+    app["line_client"] = AsyncApiClient(main.configuration)
+    app["line_api"] = AsyncMessagingApi(app["line_client"])
+    app["line_blob_api"] = AsyncMessagingApiBlob(app["line_client"])
+    app["health_task"] = asyncio.create_task(health_check_task(app))
+
+async def on_cleanup(app):
+    app["health_task"].cancel()
+    if app["tasks"]:
+        await asyncio.gather(*app["tasks"], return_exceptions=True)
+    await app["line_client"].close()
+    await app["db_pool"].close()
+    main.flush_all_logs()
+
+def create_app():
+    app = web.Application()
+    app["tasks"] = set()
+    app.router.add_post("/callback", callback)
+    app.router.add_get("/stats", stats)
+    app.router.add_get("/healthz", healthz)
+    app.router.add_get("/readyz", readyz)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+app = create_app()
+
+if __name__ == "__main__":
+    port = int(os.environ.get("PORT", 10000))
+    web.run_app(app, host="0.0.0.0", port=port)
@@ -0,0 +1,153 @@
+# 檔案：check_upload_corpus.py
+#
+# upload_corpus.py 的離線檢查：以本地的假檔案館 (FakeCorpusApi) 取代 google.generativeai，
+# 不需要 API 金鑰、不連網，確認以下情境：
+#   1. 第一次執行：每個檔案上傳並登錄一次
+#   2. 重新執行：manifest 已記錄的檔案完全不再呼叫上傳 / 登錄
+#   3. 檔案內容變更：只刪除並重做該檔案
+#   4. 變更後重做途中中斷：manifest 已寫回刪除，重跑不會沿用已刪除的雲端紀錄
+#   5. 上傳失敗或索引 FAILED：main() 回報失敗清單
+#
+# 執行方式：python check_upload_corpus.py  (全部通過時結束碼為 0)
+
+import os
+import tempfile
+import threading
+from types import SimpleNamespace
+
+import upload_corpus
+
+class FakeCorpusApi:
+    """記錄呼叫次數的記憶體檔案館；fail_uploads / fail_documents 中的顯示名稱會上傳失敗 / 索引失敗"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = {}
+        self.documents = {}
+        self.corpora = {}
+        self.calls = {"upload_file": 0, "create_document": 0, "delete_file": 0, "delete_document": 0}
+        self.fail_uploads = set()
+        self.fail_documents = set()
+
+    def _count(self, name):
+        with self.lock:
+            self.calls[name] += 1
+
+    def get_corpus(self, name):
+        if name not in self.corpora:
+            raise LookupError(name)
+        return self.corpora[name]
+
+    def create_corpus(self, name, display_name):
+        corpus = self.corpora[f"corpora/{name}"] = SimpleNamespace(name=f"corpora/{name}", display_name=display_name)
+        return corpus
+
+    def get_file(self, name):
+        if name not in self.files:
+            raise LookupError(name)
+        return self.files[name]
+
+    def upload_file(self, path, display_name, name):
+        self._count("upload_file")
+        if display_name in self.fail_uploads:
+            raise RuntimeError(f"上傳失敗: {display_name}")
+        self.files[name] = SimpleNamespace(name=name, display_name=display_name)
+        return self.files[name]
+
+    def delete_file(self, name):
+        self._count("delete_file")
+        self.files.pop(name, None)
+
+    def get_document(self, name):
+        if name not in self.documents:
+            raise LookupError(name)
+        return self.documents[name]
+
+    def create_document(self, corpus_name, file_name, display_name):
+        self._count("create_document")
+        name = f"{corpus_name}/documents/{file_name.split('/', 1)[1]}"
+        state = "FAILED" if display_name in self.fail_documents else "ACTIVE"
+        self.documents[name] = SimpleNamespace(
+            name=name, display_name=display_name, state=SimpleNamespace(name=state)
+        )
+        return self.documents[name]
+
+    def delete_document(self, name):
+        self._count("delete_document")
+        self.documents.pop(name, None)
+
+    def list_documents(self, corpus_name):
+        return [doc for name, doc in self.documents.items() if name.startswith(f"{corpus_name}/")]
+
+    def reset_calls(self):
+        for name in self.calls:
+            self.calls[name] = 0
+
+def write_pdf(corpus_dir, filename, content):
+    with open(os.path.join(corpus_dir, filename), 'wb') as f:
+        f.write(content)
+
+def run(api, corpus_dir, manifest_path):
+    api.reset_calls()
+    return upload_corpus.main(api=api, corpus_dir=corpus_dir, manifest_path=manifest_path, max_workers=2)
+
+def check(condition, message):
+    if not condition:
+        raise AssertionError(message)
+    print(f"  ✓ {message}")
+
+def main():
+    upload_corpus.POLL_INITIAL_DELAY = 0
+    with tempfile.TemporaryDirectory() as workdir:
+        corpus_dir = os.path.join(workdir, "corpus")
+        manifest_path = os.path.join(workdir, "manifest.json")
+        os.makedirs(corpus_dir)
+        names = ["第1章.pdf", "第2章.pdf", "第3章.pdf"]
+        for i, filename in enumerate(names):
+            write_pdf(corpus_dir, filename, f"PDF {i}".encode())
+        api = FakeCorpusApi()
+
+        print("1. 第一次執行")
+        corpus, failed = run(api, corpus_dir, manifest_path)
+        check(failed == [], "沒有失敗的檔案")
+        check(api.calls["upload_file"] == 3 and api.calls["create_document"] == 3, "三個檔案各上傳、登錄一次")
+        check(set(upload_corpus.Manifest(manifest_path).entries) == set(names), "manifest 記錄了所有檔案")
+
+        print("2. 重新執行")
+        corpus, failed = run(api, corpus_dir, manifest_path)
+        check(failed == [], "沒有失敗的檔案")
+        check(api.calls["upload_file"] == 0 and api.calls["create_document"] == 0, "沒有任何上傳或登錄")
+
+        print("3. 檔案內容變更")
+        write_pdf(corpus_dir, names[1], b"PDF 1 (revised)")
+        corpus, failed = run(api, corpus_dir, manifest_path)
+        check(failed == [], "沒有失敗的檔案")
+        check(api.calls["delete_file"] == 1 and api.calls["delete_document"] == 1, "只刪除變更檔案的舊版本")
+        check(api.calls["upload_file"] == 1 and api.calls["create_document"] == 1, "只重新上傳、登錄變更的檔案")
+        check(
+            upload_corpus.Manifest(manifest_path).get(names[1])["sha256"]
+            == upload_corpus.file_sha256(os.path.join(corpus_dir, names[1])),
+            "manifest 記錄新版本的 sha256"
+        )
+
+        print("4. 變更後重做途中中斷")
+        write_pdf(corpus_dir, names[2], b"PDF 2 (revised)")
+        api.fail_uploads.add(names[2])
+        corpus, failed = run(api, corpus_dir, manifest_path)
+        check(failed == [names[2]], "回報上傳失敗的檔案")
+        check(names[2] not in upload_corpus.Manifest(manifest_path).entries, "已刪除的舊紀錄同時從 manifest 移除")
+        api.fail_uploads.clear()
+        corpus, failed = run(api, corpus_dir, manifest_path)
+        check(failed == [], "修正後重跑成功")
+        check(api.calls["upload_file"] == 1 and api.calls["create_document"] == 1, "只補做中斷的檔案")
+
+        print("5. 索引失敗")
+        write_pdf(corpus_dir, "第4章.pdf", b"PDF 4")
+        api.fail_documents.add("第4章.pdf")
+        corpus, failed = run(api, corpus_dir, manifest_path)
+        check(failed == ["第4章.pdf"], "回報索引 FAILED 的檔案")
+
+    print("\n全部通過")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+# 檔案：curriculum.py
+#
+# 從教材檔名解析課程結構 (課程 / 章節 / 文件類型)。
+# main.py 的背景讀書、rebuild_database.py、upload_vectors.py 共用，
+# 寫入 teaching_materials / physics_vectors 的 course、chapter、doc_type 欄位。
+#
+# 範例：
+#   學習講義(選修II)_第05章.pdf                    → 選修物理II / 5 / 講義
+#   (教用)高中物理_全一冊_學習講義_CH1.pdf          → 物理全 / 1 / 講義
+#   Ch01測量與不確定度-教師手冊pdf檔.pdf            → None / 1 / 教師手冊
+#   02_課本-選修物理(I)_第1章　測量與不確定度.pdf  → 選修物理I / 1 / 課本
+
+import re
+import unicodedata
+
+# 課程代碼 (索引名稱只能用 ASCII)
+COURSE_SLUGS = {
+    "物理全": "phys_all",
+    "選修物理I": "elective_1",
+    "選修物理II": "elective_2",
+    "選修物理III": "elective_3",
+    "選修物理IV": "elective_4",
+    "選修物理V": "elective_5",
+}
+
+_ROMAN = r"(IV|V|III|II|I)"
+_COURSE_PATTERNS = (
+    (re.compile(rf"選修物理\s*\(?{_ROMAN}(?![IV])"), lambda m: f"選修物理{m.group(1)}"),
+    (re.compile(rf"選修\s*\(?{_ROMAN}(?![IV])"), lambda m: f"選修物理{m.group(1)}"),
+    (re.compile(r"物理全|高中物理"), lambda m: "物理全"),
+)
+_CHAPTER_PATTERNS = (
+    re.compile(r"第\s*0*(\d+)\s*章"),
+    re.compile(r"CH\s*0*(\d+)", re.IGNORECASE),
+)
+_DOC_TYPES = (
+    ("教師手冊", ("教師手冊", "教師用書")),
+    ("講義", ("講義",)),
+    ("課本", ("課本",)),
+)
+
+def parse_curriculum_metadata(filename):
+    """回傳 {"course", "chapter", "doc_type"}；無法判斷的欄位為 None"""
+    name = unicodedata.normalize("NFKC", filename)
+
+    course = None
+    for pattern, build in _COURSE_PATTERNS:
+        m = pattern.search(name)
+        if m:
+            course = build(m)
+            break
+
+    chapter = None
+    for pattern in _CHAPTER_PATTERNS:
+        m = pattern.search(name)
+        if m:
+            chapter = int(m.group(1))
+            break
+
+    doc_type = None
+    for label, keywords in _DOC_TYPES:
+        if any(k in name for k in keywords):
+            doc_type = label
+            break
+
+    return {"course": course, "chapter": chapter, "doc_type": doc_type}
+
+def normalize_course(text):
+    """將學生輸入的課程名稱 (例如「選修2」、「選修物理Ⅱ」、「物理全」) 轉為標準名稱"""
+    name = unicodedata.normalize("NFKC", text).strip().upper()
+    name = re.sub(r"選修(物理)?\s*\(?([1-5])\)?", lambda m: "選修" + ("I", "II", "III", "IV", "V")[int(m.group(2)) - 1], name)
+    return parse_curriculum_metadata(name)["course"]
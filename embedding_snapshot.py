@@ -0,0 +1,245 @@
+# 檔案：embedding_snapshot.py
+#
+# ★★★ 向量快照：匯出 / 匯入 (新環境秒速建庫，不需重新呼叫 Embedding API) ★★★
+#
+# 用法：
+#   python embedding_snapshot.py export snapshot.npz                       (預設 teaching_materials)
+#   python embedding_snapshot.py export physics.npz --table physics_vectors --float16
+#   python embedding_snapshot.py import snapshot.npz --truncate
+#   python embedding_snapshot.py info snapshot.npz
+#
+# 檔案格式：NumPy .npz (壓縮)，依欄位分開儲存：
+#   embeddings  (N, 維度) float32 / float16
+#   content / filename / course / doc_type  Unicode 陣列 (None 存成空字串)
+#   chapter / page                          int32 陣列 (None 存成 -1)
+#   meta        JSON：格式版本、Embedding 模型、維度、來源資料表、筆數、建立時間
+# 匯入時會檢查模型與維度是否與目前設定一致，不一致就拒絕 (避免混用不同模型的向量)。
+# 其他程式可用 load_snapshot() 直接把向量讀進記憶體，不必連資料庫也不必呼叫 API。
+
+import io
+import os
+import sys
+import json
+import time
+import argparse
+from datetime import datetime, timezone
+
+import numpy as np
+import psycopg2
+from pgvector.psycopg2 import register_vector
+
+from vector_storage import VECTOR_DIMENSION
+
+DATABASE_URL = os.environ.get('DATABASE_URL')
+EMBEDDING_MODEL = os.environ.get('EMBEDDING_MODEL', 'text-embedding-004')
+
+SNAPSHOT_FORMAT_VERSION = 1
+TABLES = ("teaching_materials", "physics_vectors")
+TEXT_COLUMNS = ("content", "filename", "course", "doc_type")
+INT_COLUMNS = ("chapter", "page")
+COPY_BATCH = 5000
+
+def _model_id(name):
+    """'models/text-embedding-004' 與 'text-embedding-004' 視為同一個模型"""
+    return name.split("/")[-1]
+
+def get_db_connection():
+    """連接到您的 Postgres (Neon) 資料庫"""
+    try:
+        conn = psycopg2.connect(DATABASE_URL)
+        return conn
+    except Exception as e:
+        print(f"!!! 嚴重錯誤：無法連接到資料庫。錯誤：{e}")
+        return None
+
+def _existing_columns(cur, table):
+    cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name = %s", (table,))
+    return {row[0] for row in cur.fetchall()}
+
+def export_snapshot(conn, table, path, dtype):
+    register_vector(conn)
+    with conn.cursor() as cur:
+        available = _existing_columns(cur, table)
+    if "embedding" not in available:
+        raise ValueError(f"資料表 '{table}' 不存在或沒有 embedding 欄位")
+    columns = [c for c in TEXT_COLUMNS + INT_COLUMNS if c in available]
+
+    texts = {c: [] for c in TEXT_COLUMNS}
+    ints = {c: [] for c in INT_COLUMNS}
+    vectors = []
+
+    # 伺服器端游標：分批讀取，不會一次把整張表載入 psycopg2
+    with conn.cursor(name="snapshot_export") as cur:
+        cur.itersize = 2000
+        cur.execute(f"SELECT embedding, {', '.join(columns)} FROM {table} WHERE embedding IS NOT NULL ORDER BY id")
+        for row in cur:
+            vectors.append(np.asarray(row[0], dtype=dtype))
+            values = dict(zip(columns, row[1:]))
+            for c in TEXT_COLUMNS:
+                texts[c].append(values.get(c) or "")
+            for c in INT_COLUMNS:
+                value = values.get(c)
+                ints[c].append(-1 if value is None else value)
+
+    embeddings = np.vstack(vectors) if vectors else np.zeros((0, VECTOR_DIMENSION), dtype=dtype)
+    meta = {
+        "format_version": SNAPSHOT_FORMAT_VERSION,
+        "embedding_model": _model_id(EMBEDDING_MODEL),
+        "dimension": int(embeddings.shape[1]),
+        "table": table,
+        "rows": int(embeddings.shape[0]),
+        "dtype": np.dtype(dtype).name,
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+    }
+    np.savez_compressed(
+        path,
+        meta=np.array(json.dumps(meta, ensure_ascii=False)),
+        embeddings=embeddings,
+        **{c: np.array(texts[c], dtype=np.str_) for c in TEXT_COLUMNS},
+        **{c: np.array(ints[c], dtype=np.int32) for c in INT_COLUMNS},
+    )
+    return meta
+
+def load_snapshot(path):
+    """讀取快照，回傳 (meta, embeddings, 欄位 dict)；不需要資料庫"""
+    with np.load(path, allow_pickle=False) as data:
+        meta = json.loads(str(data["meta"]))
+        if meta.get("format_version") != SNAPSHOT_FORMAT_VERSION:
+            raise ValueError(f"不支援的快照格式版本: {meta.get('format_version')}")
+        embeddings = data["embeddings"]
+        columns = {c: data[c] for c in TEXT_COLUMNS + INT_COLUMNS}
+    return meta, embeddings, columns
+
+def check_compatible(meta):
+    if meta["embedding_model"] != _model_id(EMBEDDING_MODEL):
+        raise ValueError(f"快照模型 {meta['embedding_model']} 與目前設定 {_model_id(EMBEDDING_MODEL)} 不一致")
+    if meta["dimension"] != VECTOR_DIMENSION:
+        raise ValueError(f"快照維度 {meta['dimension']} 與目前設定 {VECTOR_DIMENSION} 不一致")
+
+def _copy_field(value):
+    if value is None:
+        return "\\N"
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+def _ensure_table(cur, table):
+    cur.execute("CREATE EXTENSION IF NOT EXISTS vector;")
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {table} (
+            id SERIAL PRIMARY KEY,
+            content TEXT,
+            embedding vector({VECTOR_DIMENSION}),
+            filename TEXT,
+            course TEXT,
+            chapter INTEGER,
+            doc_type TEXT,
+            page INTEGER
+        );
+    """)
+    cur.execute(f"""
+        ALTER TABLE {table}
+            ADD COLUMN IF NOT EXISTS filename TEXT,
+            ADD COLUMN IF NOT EXISTS course TEXT,
+            ADD COLUMN IF NOT EXISTS chapter INTEGER,
+            ADD COLUMN IF NOT EXISTS doc_type TEXT,
+            ADD COLUMN IF NOT EXISTS page INTEGER;
+    """)
+
+def import_snapshot(conn, path, table=None, truncate=False, append=False):
+    meta, embeddings, columns = load_snapshot(path)
+    check_compatible(meta)
+    table = table or meta["table"]
+    if table not in TABLES:
+        raise ValueError(f"不支援的資料表: {table}")
+
+    with conn.cursor() as cur:
+        _ensure_table(cur, table)
+        cur.execute(f"SELECT EXISTS (SELECT 1 FROM {table})")
+        if cur.fetchone()[0] and not (truncate or append):
+            raise ValueError(f"'{table}' 已經有資料，請加上 --truncate (清空) 或 --append (附加)")
+        if truncate:
+            cur.execute(f"TRUNCATE TABLE {table} RESTART IDENTITY;")
+
+        copy_sql = f"COPY {table} (content, embedding, filename, course, chapter, doc_type, page) FROM STDIN"
+        total = embeddings.shape[0]
+        for start in range(0, total, COPY_BATCH):
+            buf = io.StringIO()
+            for i in range(start, min(start + COPY_BATCH, total)):
+                vector = "[" + ",".join(repr(float(x)) for x in embeddings[i]) + "]"
+                fields = [
+                    columns["content"][i],
+                    vector,
+                    columns["filename"][i] or None,
+                    columns["course"][i] or None,
+                    None if columns["chapter"][i] < 0 else int(columns["chapter"][i]),
+                    columns["doc_type"][i] or None,
+                    None if columns["page"][i] < 0 else int(columns["page"][i]),
+                ]
+                buf.write("\t".join(_copy_field(f) for f in fields) + "\n")
+            buf.seek(0)
+            cur.copy_expert(copy_sql, buf)
+            print(f"  > 已匯入 {min(start + COPY_BATCH, total)} / {total} 筆...")
+
+        cur.execute("SELECT to_regclass('imported_files') IS NOT NULL")
+        if table == "teaching_materials" and cur.fetchone()[0]:
+            # 標記為已研讀，背景讀書系統不會再重新向量化這些檔案
+            filenames = sorted({f for f in columns["filename"].tolist() if f})
+            cur.executemany(
+                "INSERT INTO imported_files (filename) VALUES (%s) ON CONFLICT (filename) DO NOTHING",
+                [(f,) for f in filenames]
+            )
+    conn.commit()
+    return meta, table
+
+def main():
+    parser = argparse.ArgumentParser(description="向量快照匯出 / 匯入")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_export = sub.add_parser("export", help="將資料表匯出成快照")
+    p_export.add_argument("path")
+    p_export.add_argument("--table", choices=TABLES, default="teaching_materials")
+    p_export.add_argument("--float16", action="store_true", help="以 float16 儲存 (檔案減半)")
+
+    p_import = sub.add_parser("import", help="從快照匯入資料表")
+    p_import.add_argument("path")
+    p_import.add_argument("--table", choices=TABLES, help="預設為快照的來源資料表")
+    group = p_import.add_mutually_exclusive_group()
+    group.add_argument("--truncate", action="store_true", help="匯入前清空資料表")
+    group.add_argument("--append", action="store_true", help="附加在既有資料後")
+
+    p_info = sub.add_parser("info", help="顯示快照資訊")
+    p_info.add_argument("path")
+    args = parser.parse_args()
+
+    if args.command == "info":
+        meta, embeddings, _ = load_snapshot(args.path)
+        print(json.dumps(meta, ensure_ascii=False, indent=2))
+        return
+
+    if not DATABASE_URL:
+        print("錯誤：DATABASE_URL 環境變數未設定！")
+        sys.exit(1)
+    conn = get_db_connection()
+    if not conn:
+        sys.exit(1)
+
+    started = time.perf_counter()
+    try:
+        if args.command == "export":
+            if not args.path.endswith(".npz"):
+                args.path += ".npz"
+            meta = export_snapshot(conn, args.table, args.path, np.float16 if args.float16 else np.float32)
+            size = os.path.getsize(args.path) / 1024 / 1024
+            print(f"--- ★ 已匯出 {meta['rows']} 筆 ({meta['table']}, {meta['embedding_model']}, {meta['dimension']} 維) → {args.path} ({size:.1f} MB) ---")
+        else:
+            meta, table = import_snapshot(conn, args.path, args.table, args.truncate, args.append)
+            print(f"--- ★ 已匯入 {meta['rows']} 筆到 '{table}' ---")
+        print(f"--- 耗時 {time.perf_counter() - started:.1f} 秒 ---")
+    except Exception as e:
+        print(f"\n!!! 嚴重錯誤：{e}")
+        conn.rollback()
+        sys.exit(1)
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+# 檔案：evaluate_retrieval.py
+#
+# ★★★ 檢索品質離線評估：recall@k / MRR / 延遲 ★★★
+#
+# 用來確認「切段方式、索引參數、量化設定」讓搜尋變快的同時沒有變差。
+#
+# 題庫格式 (JSONL，每行一題)：
+#   {"question": "什麼是有效數字？", "source": "學習講義(選修I)_第01章(教用).pdf", "page": 12}
+#   - source：預期命中的 corpus/ 檔名 (必填)
+#   - page  ：預期頁碼 (選填；填寫且檢索結果帶有頁碼時才比對頁碼)
+#   - filters：搜尋範圍 (選填)，例如 {"course": "選修物理I", "chapter": 1}
+#
+# 只使用 vector_storage.py 的檢索查詢，不匯入 main.py：不會改動資料表結構，也不需要 LINE / Sheets 金鑰
+# (只需要 DATABASE_URL 與 GOOGLE_API_KEY)。
+#
+# 用法 (請將 DATABASE_URL 指向本機資料庫)：
+#   python evaluate_retrieval.py eval_questions.jsonl
+#   python evaluate_retrieval.py eval_questions.jsonl --output report.json --baseline old_report.json
+#   python evaluate_retrieval.py eval_questions.jsonl --config halfvec:256:80 --config binary:768:200
+#
+# 每個設定寫成 mode:dim:candidates，沒有指定時使用下方 DEFAULT_CONFIGS。
+# 報告為排序過的 JSON，可以直接 git diff 比較前後兩次的結果。
+
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+
+import psycopg2
+from google import genai
+
+from vector_storage import VECTOR_DIMENSION, RERANK_CANDIDATES, run_search
+
+DATABASE_URL = os.environ.get('DATABASE_URL')
+GOOGLE_API_KEY = os.environ.get('GOOGLE_API_KEY')
+EMBEDDING_MODEL = os.environ.get('EMBEDDING_MODEL', 'text-embedding-004')
+
+K_VALUES = (1, 3, 5, 10)
+DEFAULT_CONFIGS = (
+    "full:768:40",
+    "halfvec:768:40",
+    "halfvec:256:80",
+    "binary:768:200",
+)
+
+def load_questions(path):
+    questions = []
+    with open(path, encoding='utf-8') as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            item = json.loads(line)
+            if not item.get("question") or not item.get("source"):
+                raise ValueError(f"第 {line_no} 行缺少 question 或 source")
+            questions.append(item)
+    return questions
+
+def parse_config(spec):
+    mode, dim, candidates = (spec.split(":") + ["", ""])[:3]
+    return {
+        "name": spec,
+        "mode": mode,
+        "dim": int(dim or VECTOR_DIMENSION),
+        "candidates": int(candidates or RERANK_CANDIDATES),
+    }
+
+def is_hit(row, expected):
+    filename = os.path.basename(row[1] or "")
+    if filename != os.path.basename(expected["source"]):
+        return False
+    page = row[2] if len(row) > 2 else None
+    return expected.get("page") is None or page is None or page == expected["page"]
+
+def first_hit_rank(rows, expected):
+    for rank, row in enumerate(rows, 1):
+        if is_hit(row, expected):
+            return rank
+    return None
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+def latency_summary(values):
+    return {
+        "p50_ms": round(percentile(values, 50), 2),
+        "p90_ms": round(percentile(values, 90), 2),
+        "p99_ms": round(percentile(values, 99), 2),
+        "mean_ms": round(statistics.mean(values), 2),
+    }
+
+def get_embedding(client, text):
+    """取得查詢向量 (重試 3 次)，失敗回傳 None"""
+    for _ in range(3):
+        try:
+            response = client.models.embed_content(model=EMBEDDING_MODEL, contents=text)
+            return response.embeddings[0].values
+        except Exception as e:
+            print(f"Embedding 錯誤: {e}")
+            time.sleep(1)
+    return None
+
+def evaluate_config(conn, config, embedded):
+    top_k = max(K_VALUES)
+    ranks, latencies, misses = [], [], []
+    for item, vec in embedded:
+        started = time.perf_counter()
+        rows = run_search(
+            conn, vec, top_k, config["mode"], config["dim"], config["candidates"], filters=item.get("filters")
+        )
+        conn.rollback()   # 結束 SET LOCAL 所在的交易
+        latencies.append((time.perf_counter() - started) * 1000)
+        rank = first_hit_rank(rows, item)
+        ranks.append(rank)
+        if rank is None:
+            misses.append(item["question"])
+
+    n = len(ranks)
+    return {
+        "config": {k: config[k] for k in ("mode", "dim", "candidates")},
+        "recall": {f"@{k}": round(sum(1 for r in ranks if r and r <= k) / n, 4) for k in K_VALUES},
+        "mrr": round(sum(1 / r for r in ranks if r) / n, 4),
+        "latency": latency_summary(latencies),
+        "misses": sorted(misses),
+    }
+
+def print_table(report, baseline=None):
+    print(f"\n--- 檢索評估：{report['questions']} 題 ---")
+    header = f"  {'設定':<18}" + "".join(f"{'R@' + str(k):>8}" for k in K_VALUES) + f"{'MRR':>8}{'p50':>9}{'p90':>9}{'p99':>9}"
+    print(header)
+    for name, result in report["configs"].items():
+        line = f"  {name:<18}" + "".join(f"{result['recall'][f'@{k}']:>8.3f}" for k in K_VALUES)
+        line += f"{result['mrr']:>8.3f}"
+        line += "".join(f"{result['latency'][p]:>9.1f}" for p in ("p50_ms", "p90_ms", "p99_ms"))
+        print(line)
+        old = (baseline or {}).get("configs", {}).get(name)
+        if old:
+            delta = f"  {'  Δ vs baseline':<18}" + "".join(
+                f"{result['recall'][f'@{k}'] - old['recall'][f'@{k}']:>+8.3f}" for k in K_VALUES
+            )
+            delta += f"{result['mrr'] - old['mrr']:>+8.3f}"
+            delta += "".join(f"{result['latency'][p] - old['latency'][p]:>+9.1f}" for p in ("p50_ms", "p90_ms", "p99_ms"))
+            print(delta)
+    emb = report["embedding_latency"]
+    print(f"  (查詢向量化延遲 p50 {emb['p50_ms']:.1f} ms / p90 {emb['p90_ms']:.1f} ms，不計入上表)")
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="檢索品質離線評估")
+    parser.add_argument("questions", help="標註題庫 (JSONL)")
+    parser.add_argument("--config", action="append", help="mode:dim:candidates，可重複指定")
+    parser.add_argument("--output", help="報告輸出路徑 (JSON)")
+    parser.add_argument("--baseline", help="上一次的報告，用來顯示差異")
+    args = parser.parse_args()
+
+    questions = load_questions(args.questions)
+    if not questions:
+        print("!!! 錯誤：題庫是空的。")
+        sys.exit(1)
+
+    if not DATABASE_URL or not GOOGLE_API_KEY:
+        print("錯誤：請設定 DATABASE_URL 與 GOOGLE_API_KEY 環境變數！")
+        sys.exit(1)
+    client = genai.Client(api_key=GOOGLE_API_KEY)
+
+    # 每題只向量化一次，所有設定共用同一個查詢向量
+    print(f"--- 正在將 {len(questions)} 題向量化... ---")
+    embedded, embed_ms = [], []
+    for item in questions:
+        started = time.perf_counter()
+        vec = get_embedding(client, item["question"])
+        embed_ms.append((time.perf_counter() - started) * 1000)
+        if vec is None:
+            print(f"!!! 警告：無法向量化，略過：{item['question'][:30]}")
+            continue
+        embedded.append((item, vec))
+    if not embedded:
+        print("!!! 錯誤：沒有任何題目成功向量化。")
+        sys.exit(1)
+
+    report = {
+        "questions": len(embedded),
+        "embedding_latency": latency_summary(embed_ms),
+        "configs": {},
+    }
+    conn = psycopg2.connect(DATABASE_URL)
+    try:
+        for spec in args.config or DEFAULT_CONFIGS:
+            config = parse_config(spec)
+            print(f"--- 正在評估設定 {config['name']} ... ---")
+            report["configs"][config["name"]] = evaluate_config(conn, config, embedded)
+    finally:
+        conn.close()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_table(report, baseline)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"--- 報告已寫入 {args.output} ---")
+
+if __name__ == "__main__":
+    main_cli()
@@ -2,12 +2,20 @@ import os
 import logging
 import time
 import threading
+import re
 import json
 import tempfile
-from datetime import datetime
+import hashlib
+import unicodedata
+import gzip
+import queue
+import atexit
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from datetime import datetime, date, timedelta
 
 # --- 1. 基礎框架 (Flask & Line Bot) ---
-from flask import Flask, request, abort
+from flask import Flask, request, abort, jsonify
 from linebot.v3 import WebhookHandler
 from linebot.v3.exceptions import InvalidSignatureError
 from linebot.v3.messaging import (
@@ -30,9 +38,15 @@ import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 
 # --- 4. 進階功能疊加 (PDF 處理 & PostgreSQL 資料庫) ---
-from pypdf import PdfReader
+from pdf_extract import extract_pages, ensure_extracted
 import psycopg2
-from psycopg2.extras import Json
+from psycopg2.pool import ThreadedConnectionPool, PoolError
+from psycopg2.extras import Json, execute_values
+
+from curriculum import parse_curriculum_metadata, normalize_course, COURSE_SLUGS
+from vector_storage import (
+    VECTOR_STORAGE, COMPACT_DIMENSION, RERANK_CANDIDATES, run_search
+)
 
 # 設定日誌
 logging.basicConfig(level=logging.INFO)
@@ -51,9 +65,173 @@ DATABASE_URL = os.environ.get('DATABASE_URL')
 # 初始化設定
 configuration = Configuration(access_token=CHANNEL_ACCESS_TOKEN)
 handler = WebhookHandler(CHANNEL_SECRET)
+# 共用同一個 LINE API client (連線池 keep-alive)，不再每次呼叫都重新建立連線
+line_api_client = ApiClient(configuration)
+line_bot_api = MessagingApi(line_api_client)
+
+# 外部服務逾時 (秒)：避免單一依賴卡住時拖垮所有 worker
+GEMINI_TIMEOUT = float(os.environ.get('GEMINI_TIMEOUT', 120))
+DB_CONNECT_TIMEOUT = int(os.environ.get('DB_CONNECT_TIMEOUT', 5))
+DB_STATEMENT_TIMEOUT = int(os.environ.get('DB_STATEMENT_TIMEOUT', 15))
+SHEETS_TIMEOUT = float(os.environ.get('SHEETS_TIMEOUT', 10))
 
 # [更新] 初始化 Google GenAI Client
-gemini_client = genai.Client(api_key=GOOGLE_API_KEY)
+gemini_client = genai.Client(
+    api_key=GOOGLE_API_KEY,
+    http_options=types.HttpOptions(timeout=int(GEMINI_TIMEOUT * 1000))  # (毫秒)
+)
+
+# 模型與提示詞 (同步 main.py 與非同步 async_app.py 共用)
+EMBEDDING_MODEL = "text-embedding-004"
+TEXT_MODEL = 'gemini-2.5-pro'
+IMAGE_MODEL = 'gemini-2.5-flash-image'
+AUDIO_MODEL = 'gemini-2.5-flash'
+IMAGE_PROMPT = "這是一題物理題目，請幫我詳細解題："
+AUDIO_PROMPT = "請回答這段語音的問題："
+BUSY_MESSAGE = "抱歉，系統目前忙碌中，請稍後再試。"
+
+# ==========================================
+# [穩定性] 斷路器 (Google Sheets / Gemini / PostgreSQL)
+# ==========================================
+# 依賴服務連續出錯時先「斷開」一段時間，直接走降級路徑，不再每次等逾時或重試：
+#   - 資料庫斷開：不查教材，直接由 Gemini 回答 (無 RAG)；事件去重只用記憶體
+#   - Sheets 斷開：紀錄只寫資料庫
+#   - Gemini 斷開：立即回覆忙碌訊息
+# 斷開 BREAKER_OPEN_SECONDS 秒後進入半開狀態，放行少量試探請求，成功就恢復。
+BREAKER_WINDOW = int(os.environ.get('BREAKER_WINDOW', 60))                  # (秒) 失敗率統計區間
+BREAKER_FAILURE_RATE = float(os.environ.get('BREAKER_FAILURE_RATE', 0.5))  # 區間內失敗率達此值就斷開
+BREAKER_MIN_CALLS = int(os.environ.get('BREAKER_MIN_CALLS', 5))            # 區間內至少幾次呼叫才判斷
+BREAKER_OPEN_SECONDS = int(os.environ.get('BREAKER_OPEN_SECONDS', 30))     # (秒) 斷開多久後試探
+BREAKER_HALF_OPEN_PROBES = int(os.environ.get('BREAKER_HALF_OPEN_PROBES', 1))
+
+class CircuitOpenError(Exception):
+    """斷路器斷開中，呼叫未送出"""
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+    LABELS = {CLOSED: "✅ 正常", OPEN: "⛔ 斷開", HALF_OPEN: "🟡 試探中"}
+
+    def __init__(self, name, window=None, failure_rate=None, min_calls=None, open_seconds=None, half_open_probes=None):
+        self.name = name
+        self.window = window or BREAKER_WINDOW
+        self.failure_rate = failure_rate or BREAKER_FAILURE_RATE
+        self.min_calls = min_calls or BREAKER_MIN_CALLS
+        self.open_seconds = open_seconds or BREAKER_OPEN_SECONDS
+        self.half_open_probes = half_open_probes or BREAKER_HALF_OPEN_PROBES
+        self.state = self.CLOSED
+        self.opened_count = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._results = deque()   # (時間, 是否成功)
+        self._opened_at = 0.0
+        self._probes = 0
+
+    def _trim(self, now):
+        while self._results and now - self._results[0][0] > self.window:
+            self._results.popleft()
+
+    def _open(self, now):
+        self.state = self.OPEN
+        self.opened_count += 1
+        self._opened_at = now
+        self._probes = 0
+        self._results.clear()
+        print(f"⛔ 斷路器斷開: {self.name} ({self.open_seconds} 秒後試探)")
+
+    def allow(self):
+        """是否放行這次呼叫；放行後必須呼叫 record() 或 release()"""
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.open_seconds:
+                    self.rejected += 1
+                    return False
+                self.state = self.HALF_OPEN
+                self._probes = 0
+            if self.state == self.HALF_OPEN:
+                if self._probes >= self.half_open_probes:
+                    self.rejected += 1
+                    return False
+                self._probes += 1
+            return True
+
+    def record(self, ok):
+        with self._lock:
+            now = time.monotonic()
+            if self.state == self.HALF_OPEN:
+                if ok:
+                    self.state = self.CLOSED
+                    self._results.clear()
+                    print(f"✅ 斷路器恢復: {self.name}")
+                else:
+                    self._open(now)
+                return
+            if self.state == self.OPEN:
+                return
+            self._results.append((now, ok))
+            self._trim(now)
+            failures = sum(1 for _, success in self._results if not success)
+            if len(self._results) >= self.min_calls and failures / len(self._results) >= self.failure_rate:
+                self._open(now)
+
+    def release(self):
+        """放行的呼叫被取消 (沒有結果)：歸還半開狀態的試探名額"""
+        with self._lock:
+            if self.state == self.HALF_OPEN and self._probes:
+                self._probes -= 1
+
+    def call(self, fn, *args, **kwargs):
+        if not self.allow():
+            raise CircuitOpenError(f"{self.name} 斷路中")
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            self.record(False)
+            raise
+        except BaseException:
+            self.release()
+            raise
+        self.record(True)
+        return result
+
+    async def call_async(self, fn, *args, **kwargs):
+        """非同步版 call() (async_app.py 使用)"""
+        if not self.allow():
+            raise CircuitOpenError(f"{self.name} 斷路中")
+        try:
+            result = await fn(*args, **kwargs)
+        except Exception:
+            self.record(False)
+            raise
+        except BaseException:
+            self.release()
+            raise
+        self.record(True)
+        return result
+
+    @property
+    def is_open(self):
+        """斷開且尚未到試探時間 (不消耗試探名額)"""
+        with self._lock:
+            return self.state == self.OPEN and time.monotonic() - self._opened_at < self.open_seconds
+
+    def describe(self):
+        with self._lock:
+            now = time.monotonic()
+            self._trim(now)
+            label = self.LABELS[self.state]
+            if self.state == self.OPEN:
+                remaining = max(0, self.open_seconds - (now - self._opened_at))
+                return f"{label} (約 {remaining:.0f} 秒後試探，已擋下 {self.rejected} 次)"
+            failures = sum(1 for _, success in self._results if not success)
+            return f"{label} (近 {self.window} 秒失敗 {failures}/{len(self._results)}，累計斷開 {self.opened_count} 次)"
+
+db_breaker = CircuitBreaker("PostgreSQL")
+gemini_breaker = CircuitBreaker("Gemini")
+sheets_breaker = CircuitBreaker("Google Sheets")
+BREAKERS = (db_breaker, gemini_breaker, sheets_breaker)
+
+def breaker_summary():
+    return "\n".join(f"  {b.name}: {b.describe()}" for b in BREAKERS)
 
 # ==========================================
 # [安全性升級] Google Sheets 連線
@@ -75,6 +253,7 @@ def init_google_sheet():
 
         creds = ServiceAccountCredentials.from_json_keyfile_name(key_path, scope)
         client = gspread.authorize(creds)
+        client.set_timeout(SHEETS_TIMEOUT)
         sheet = client.open("Research_Log").sheet1 
         print(f"✅ Google Sheet 連線成功 (使用金鑰: {key_path})")
         return sheet
@@ -87,8 +266,89 @@ google_sheet = init_google_sheet()
 # ==========================================
 # [進階核心] PostgreSQL 資料庫
 # ==========================================
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 10))
+DB_CONNECT_ARGS = {
+    "connect_timeout": DB_CONNECT_TIMEOUT,
+    "options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT * 1000}",
+}
+
 def get_db_connection():
-    return psycopg2.connect(DATABASE_URL)
+    """獨立連線 (背景工作用)；資料庫斷路中會直接拋出 CircuitOpenError，不再等待連線逾時"""
+    return db_breaker.call(psycopg2.connect, DATABASE_URL, **DB_CONNECT_ARGS)
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+def get_db_pool():
+    """第一次呼叫時建立連線池 (同時開好 DB_POOL_MIN 條連線)"""
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is None:
+            _db_pool = ThreadedConnectionPool(DB_POOL_MIN, DB_POOL_MAX, DATABASE_URL, **DB_CONNECT_ARGS)
+        return _db_pool
+
+DB_FAILURES = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+@contextmanager
+def pooled_connection():
+    """
+    對話路徑用的連線 (從連線池借用，用完歸還)。
+    整段借用 (取得連線 + 區塊內的查詢) 算一次資料庫呼叫計入斷路器：
+    連線失敗、斷線或查詢逾時記為失敗並丟棄連線；資料庫有正常回應 (含 SQL 錯誤) 記為成功。
+    離開時未提交的交易會 rollback。
+    """
+    if not db_breaker.allow():
+        raise CircuitOpenError(f"{db_breaker.name} 斷路中")
+    pool = None
+    try:
+        pool = get_db_pool()
+        conn = _getconn(pool)
+        if conn is None:
+            # 連線池用完時退回獨立連線，不讓請求失敗
+            pool = None
+            conn = psycopg2.connect(DATABASE_URL, **DB_CONNECT_ARGS)
+    except DB_FAILURES:
+        db_breaker.record(False)
+        raise
+    except BaseException:
+        db_breaker.release()
+        raise
+
+    try:
+        yield conn
+    except DB_FAILURES:
+        db_breaker.record(False)
+        _return_connection(pool, conn, discard=True)
+        raise
+    except psycopg2.Error:
+        db_breaker.record(True)
+        _return_connection(pool, conn)
+        raise
+    except BaseException:
+        db_breaker.release()
+        _return_connection(pool, conn)
+        raise
+    db_breaker.record(True)
+    _return_connection(pool, conn)
+
+def _getconn(pool):
+    try:
+        return pool.getconn()
+    except PoolError:
+        return None
+
+def _return_connection(pool, conn, discard=False):
+    """歸還連線池 (獨立連線則關閉)；已中斷的連線直接丟棄"""
+    try:
+        if not discard and not conn.closed:
+            conn.rollback()
+    except psycopg2.Error:
+        discard = True
+    if pool is None:
+        conn.close()
+    else:
+        pool.putconn(conn, close=discard or bool(conn.closed))
 
 def initialize_database():
     """初始化資料庫結構"""
@@ -112,15 +372,40 @@ def initialize_database():
                 imported_at TIMESTAMPTZ DEFAULT NOW()
             );
         """)
+        # 課程結構欄位 (由檔名解析，見 curriculum.py)
         cur.execute("""
-            CREATE TABLE IF NOT EXISTS system_logs (
-                id SERIAL PRIMARY KEY,
-                user_id TEXT,
-                user_name TEXT,
-                message_type TEXT,
-                input_content TEXT,
-                output_content TEXT,
-                timestamp TIMESTAMPTZ DEFAULT NOW()
+            ALTER TABLE teaching_materials
+                ADD COLUMN IF NOT EXISTS course TEXT,
+                ADD COLUMN IF NOT EXISTS chapter INTEGER,
+                ADD COLUMN IF NOT EXISTS doc_type TEXT,
+                ADD COLUMN IF NOT EXISTS page INTEGER;
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS teaching_materials_course_chapter_idx ON teaching_materials (course, chapter);")
+        cur.execute("CREATE INDEX IF NOT EXISTS teaching_materials_doc_type_idx ON teaching_materials (doc_type);")
+        backfill_curriculum_metadata(cur)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS user_preferences (
+                user_id TEXT PRIMARY KEY,
+                course TEXT,
+                chapter INTEGER,
+                updated_at TIMESTAMPTZ DEFAULT NOW()
+            );
+        """)
+        ensure_system_logs_partitioned(cur)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS processed_events (
+                event_id TEXT PRIMARY KEY,
+                processed_at TIMESTAMPTZ DEFAULT NOW()
+            );
+        """)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS conversation_state (
+                user_id TEXT PRIMARY KEY,
+                summary TEXT,
+                turns JSONB,
+                materials JSONB,
+                filters JSONB,
+                updated_at TIMESTAMPTZ DEFAULT NOW()
             );
         """)
         conn.commit()
@@ -132,32 +417,305 @@ def initialize_database():
         cur.close()
         conn.close()
 
+def backfill_curriculum_metadata(cur):
+    """為舊資料補上課程/章節/類型 (每個檔名只解析一次)"""
+    cur.execute("""
+        SELECT DISTINCT filename FROM teaching_materials
+        WHERE filename IS NOT NULL AND course IS NULL AND chapter IS NULL AND doc_type IS NULL;
+    """)
+    for (filename,) in cur.fetchall():
+        meta = parse_curriculum_metadata(filename)
+        if any(meta.values()):
+            cur.execute("""
+                UPDATE teaching_materials SET course = %s, chapter = %s, doc_type = %s
+                WHERE filename = %s AND course IS NULL AND chapter IS NULL AND doc_type IS NULL;
+            """, (meta["course"], meta["chapter"], meta["doc_type"], filename))
+
+# ==========================================
+# [紀錄維護] system_logs 月分區、保留期限與統計彙總
+# ==========================================
+# system_logs 依 timestamp 按月分區；報表只讀取 system_log_daily_stats 彙總表，不掃描正在寫入的分區。
+# 封存需明確設定 LOG_ARCHIVE_DIR (必須是持久磁碟，例如 Render Disk 的掛載路徑)：
+# 超過保留期限的分區匯出成 gzip CSV 並確認寫入後才移除；未設定時分區全部保留在資料庫。
+LOG_RETENTION_MONTHS = int(os.environ.get('LOG_RETENTION_MONTHS', 12))
+LOG_ARCHIVE_DIR = os.environ.get('LOG_ARCHIVE_DIR')
+LOG_MAINTENANCE_INTERVAL = 3600   # (秒)
+STATS_TIMEZONE = os.environ.get('STATS_TIMEZONE', 'Asia/Taipei')
+STATS_TOKEN = os.environ.get('STATS_TOKEN')
+LOG_LOCK_KEY = 2601030            # 多個 worker 同時維護時的 advisory lock
+
+def _add_months(month, n):
+    y, m = divmod(month.month - 1 + n, 12)
+    return date(month.year + y, m + 1, 1)
+
+def _log_partition_name(month):
+    return f"system_logs_{month:%Y_%m}"
+
+def create_log_partition(cur, month):
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {_log_partition_name(month)} PARTITION OF system_logs
+        FOR VALUES FROM (%s) TO (%s);
+    """, (month, _add_months(month, 1)))
+
+def ensure_system_logs_partitioned(cur):
+    """建立 (或從舊版單一資料表遷移成) 按月分區的 system_logs"""
+    cur.execute("SELECT pg_advisory_xact_lock(%s)", (LOG_LOCK_KEY,))
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('system_logs')")
+    row = cur.fetchone()
+    kind = row[0] if row else None
+
+    if kind == 'r':
+        # 舊版：一般資料表 → 改名保留，建立分區表後搬移
+        print("🔧 正在將 system_logs 遷移為月分區資料表...")
+        cur.execute("ALTER TABLE system_logs RENAME TO system_logs_legacy")
+        cur.execute("ALTER SEQUENCE IF EXISTS system_logs_id_seq RENAME TO system_logs_legacy_id_seq")
+
+    if kind != 'p':
+        cur.execute("""
+            CREATE TABLE system_logs (
+                id BIGSERIAL,
+                user_id TEXT,
+                user_name TEXT,
+                message_type TEXT,
+                input_content TEXT,
+                output_content TEXT,
+                timestamp TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                PRIMARY KEY (id, timestamp)
+            ) PARTITION BY RANGE (timestamp);
+        """)
+
+    cur.execute("CREATE INDEX IF NOT EXISTS system_logs_user_id_idx ON system_logs (user_id);")
+    cur.execute("CREATE INDEX IF NOT EXISTS system_logs_timestamp_idx ON system_logs (timestamp);")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS system_log_daily_stats (
+            day DATE NOT NULL,
+            message_type TEXT NOT NULL,
+            messages INTEGER NOT NULL,
+            active_users INTEGER NOT NULL,
+            avg_answer_length REAL,
+            PRIMARY KEY (day, message_type)
+        );
+    """)
+
+    this_month = date.today().replace(day=1)
+    first_month = this_month
+    if kind == 'r':
+        cur.execute("SELECT MIN(timestamp) FROM system_logs_legacy")
+        oldest = cur.fetchone()[0]
+        if oldest:
+            first_month = min(this_month, oldest.date().replace(day=1))
+
+    month = first_month
+    while month <= _add_months(this_month, 1):
+        create_log_partition(cur, month)
+        month = _add_months(month, 1)
+
+    if kind == 'r':
+        cur.execute("""
+            INSERT INTO system_logs (id, user_id, user_name, message_type, input_content, output_content, timestamp)
+            SELECT id, user_id, user_name, message_type, input_content, output_content, COALESCE(timestamp, NOW())
+            FROM system_logs_legacy;
+        """)
+        cur.execute("SELECT setval(pg_get_serial_sequence('system_logs', 'id'), COALESCE(MAX(id), 0) + 1, false) FROM system_logs")
+        cur.execute("DROP TABLE system_logs_legacy")
+        refresh_log_stats(cur, first_month)
+        print("✅ system_logs 分區遷移完成")
+
+def refresh_log_stats(cur, since):
+    """重新計算 since (含) 之後每日的彙總；message_type='*' 代表全部類型"""
+    cur.execute("""
+        INSERT INTO system_log_daily_stats (day, message_type, messages, active_users, avg_answer_length)
+        SELECT
+            (timestamp AT TIME ZONE %(tz)s)::date,
+            CASE WHEN GROUPING(message_type) = 1 THEN '*' ELSE COALESCE(message_type, 'unknown') END,
+            COUNT(*),
+            COUNT(DISTINCT user_id),
+            AVG(char_length(output_content))
+        FROM system_logs
+        WHERE timestamp >= (%(since)s::date)::timestamp AT TIME ZONE %(tz)s
+        GROUP BY GROUPING SETS (((timestamp AT TIME ZONE %(tz)s)::date, message_type),
+                                ((timestamp AT TIME ZONE %(tz)s)::date))
+        ON CONFLICT (day, message_type) DO UPDATE SET
+            messages = EXCLUDED.messages,
+            active_users = EXCLUDED.active_users,
+            avg_answer_length = EXCLUDED.avg_answer_length;
+    """, {"tz": STATS_TIMEZONE, "since": since})
+
+def archive_old_log_partitions(cur):
+    """將超過保留期限的分區匯出成 gzip CSV 後移除 (需設定 LOG_ARCHIVE_DIR)"""
+    if not LOG_ARCHIVE_DIR:
+        return
+    cutoff = _add_months(date.today().replace(day=1), -LOG_RETENTION_MONTHS)
+    cur.execute("""
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'system_logs'::regclass
+        ORDER BY c.relname;
+    """)
+    for (name,) in cur.fetchall():
+        try:
+            month = datetime.strptime(name, "system_logs_%Y_%m").date()
+        except ValueError:
+            continue
+        if _add_months(month, 1) > cutoff:
+            continue
+
+        os.makedirs(LOG_ARCHIVE_DIR, exist_ok=True)
+        path = os.path.join(LOG_ARCHIVE_DIR, f"{name}.csv.gz")
+        temp_path = path + ".tmp"
+        with open(temp_path, 'wb') as raw:
+            with gzip.open(raw, 'wt', encoding='utf-8') as f:
+                cur.copy_expert(f"COPY {name} TO STDOUT WITH CSV HEADER", f)
+            raw.flush()
+            os.fsync(raw.fileno())
+        # 確認封存檔完整可讀後才移除分區
+        with gzip.open(temp_path, 'rt', encoding='utf-8') as f:
+            for _ in f:
+                pass
+        os.replace(temp_path, path)
+        cur.execute(f"ALTER TABLE system_logs DETACH PARTITION {name}")
+        cur.execute(f"DROP TABLE {name}")
+        print(f"📦 已封存 {name} → {path}")
+
+def log_maintenance_task():
+    """定期：預建下個月分區、更新近兩日統計、封存過期分區"""
+    while True:
+        try:
+            conn = get_db_connection()
+            cur = conn.cursor()
+            try:
+                cur.execute("SELECT pg_advisory_xact_lock(%s)", (LOG_LOCK_KEY,))
+                this_month = date.today().replace(day=1)
+                create_log_partition(cur, this_month)
+                create_log_partition(cur, _add_months(this_month, 1))
+                refresh_log_stats(cur, date.today() - timedelta(days=1))
+                archive_old_log_partitions(cur)
+                cur.execute(CLEANUP_CONVERSATIONS_SQL, (CONVERSATION_RETENTION_DAYS,))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cur.close()
+                conn.close()
+        except Exception as e:
+            print(f"⚠️ 紀錄維護任務異常: {e}")
+        time.sleep(LOG_MAINTENANCE_INTERVAL)
+
+def get_usage_stats(days=7):
+    """查詢彙總統計 (每日活躍人數、各類型訊息數、平均回答長度)"""
+    with pooled_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT day, message_type, messages, active_users, avg_answer_length
+            FROM system_log_daily_stats
+            WHERE day > (NOW() AT TIME ZONE %s)::date - %s
+            ORDER BY day, message_type;
+        """, (STATS_TIMEZONE, days))
+        rows = cur.fetchall()
+        cur.close()
+
+    stats = {}
+    for day, m_type, messages, active_users, avg_len in rows:
+        entry = stats.setdefault(day.isoformat(), {"daily_active_users": 0, "messages": {}, "avg_answer_length": None})
+        if m_type == '*':
+            entry["daily_active_users"] = active_users
+            entry["avg_answer_length"] = round(avg_len, 1) if avg_len is not None else None
+        else:
+            entry["messages"][m_type] = messages
+    return stats
+
 # ==========================================
 # [自動學習] 背景讀書系統 (RAG) - SDK 更新版
 # ==========================================
-def extract_text_from_pdf(pdf_stream):
-    try:
-        reader = PdfReader(pdf_stream)
-        text = ""
-        for page in reader.pages:
-            p_text = page.extract_text()
-            if p_text: text += p_text
-        return text.replace('\x00', '')
-    except Exception as e:
-        print(f"❌ PDF 解析失敗: {e}")
-        return ""
+# 切段設定：以段落 / 句子為界 (支援中文標點)，不跨頁，相鄰片段保留少量重疊
+CHUNK_SIZE = int(os.environ.get('CHUNK_SIZE', 1000))
+CHUNK_OVERLAP = int(os.environ.get('CHUNK_OVERLAP', 150))
+
+_PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+_SENTENCE_END = re.compile(r"(?<=[。！？；!?;])|(?<=\.)(?=\s)")
+_CJK = r"\u3000-\u303f\u3400-\u9fff\uff00-\uffef"
+_CJK_LINE_WRAP = re.compile(rf"(?<=[{_CJK}])[ \t]*\n[ \t]*(?=[{_CJK}])")
+
+# 研讀失敗的檔案依失敗次數加倍等待再重試 (LEARN_RETRY_BASE 秒起跳，最長 LEARN_RETRY_MAX 秒)，不會每輪都重新解析壞檔；
+# 連續失敗 LEARN_MAX_ATTEMPTS 次就放棄 (重新啟動程序後才會再試)
+LEARN_RETRY_BASE = int(os.environ.get('LEARN_RETRY_BASE', 60))
+LEARN_RETRY_MAX = int(os.environ.get('LEARN_RETRY_MAX', 6 * 3600))
+LEARN_MAX_ATTEMPTS = int(os.environ.get('LEARN_MAX_ATTEMPTS', 5))
+_learn_failures = {}   # 檔名 → (連續失敗次數, 下次可重試的 time.monotonic())
+
+def record_learn_failure(f_name):
+    count = _learn_failures.get(f_name, (0, 0))[0] + 1
+    delay = min(LEARN_RETRY_BASE * 2 ** (count - 1), LEARN_RETRY_MAX)
+    _learn_failures[f_name] = (count, time.monotonic() + delay)
+    return count, delay
+
+def learn_retry_due(f_name):
+    failure = _learn_failures.get(f_name)
+    if failure is None:
+        return True
+    return failure[0] < LEARN_MAX_ATTEMPTS and time.monotonic() >= failure[1]
+
+def iter_pdf_pages(pdf_path):
+    """
+    逐頁產生 (頁碼, 文字)，不把整份文件組成一個大字串 (解析結果快取於磁碟，見 pdf_extract.py)。
+    任何一頁解析失敗都會拋出例外，呼叫端不可把只讀了一半的檔案標記為已研讀。
+    """
+    for page_num, p_text in extract_pages(pdf_path, extractor="pypdf", skip_failed_pages=False):
+        if p_text.strip():
+            yield page_num, p_text
+
+def _iter_sentences(text, max_len):
+    """依段落與句末標點切出句子 (超過 max_len 的句子硬切)；中文換行 (PDF 排版斷行) 直接接起來"""
+    for paragraph in _PARAGRAPH_BREAK.split(text):
+        paragraph = _CJK_LINE_WRAP.sub("", paragraph.strip())
+        paragraph = re.sub(r"\s*\n\s*", " ", paragraph)
+        if not paragraph:
+            continue
+        sentences = [s for s in _SENTENCE_END.split(paragraph) if s.strip()]
+        for i, sentence in enumerate(sentences):
+            # 單句超過片段長度時硬切
+            for start in range(0, len(sentence), max_len):
+                yield sentence[start:start + max_len], i == len(sentences) - 1
+
+def chunk_page_text(text, chunk_size=None, overlap=None):
+    """將單頁文字切成不超過 chunk_size 的片段，句子不會被切斷"""
+    chunk_size = chunk_size or CHUNK_SIZE
+    overlap = CHUNK_OVERLAP if overlap is None else overlap
+    current, length = [], 0
+    for sentence, ends_paragraph in _iter_sentences(text, chunk_size):
+        if current and length + len(sentence) > chunk_size:
+            yield "".join(s for s, _ in current).strip()
+            # 從上一個片段尾端保留不超過 overlap 字的完整句子
+            kept, kept_len = [], 0
+            for s, end in reversed(current):
+                if kept_len + len(s) > overlap:
+                    break
+                kept.insert(0, (s, end))
+                kept_len += len(s)
+            if kept_len + len(sentence) > chunk_size:
+                kept, kept_len = [], 0
+            current, length = kept, kept_len
+        piece = sentence + ("\n" if ends_paragraph else "")
+        current.append((piece, ends_paragraph))
+        length += len(piece)
+    if current:
+        yield "".join(s for s, _ in current).strip()
 
 def get_embedding(text):
-    """取得向量 (使用新版 SDK)"""
+    """取得向量 (使用新版 SDK)；Gemini 斷路中直接回傳 None"""
     for _ in range(3):
         try:
             # [更新] 新版 Embedding 語法
-            response = gemini_client.models.embed_content(
-                model="text-embedding-004",
+            response = gemini_breaker.call(
+                gemini_client.models.embed_content,
+                model=EMBEDDING_MODEL,
                 contents=text
             )
             # 新版回傳的是物件，需取出 values
             return response.embeddings[0].values
+        except CircuitOpenError:
+            return None
         except Exception as e:
             print(f"Embedding 錯誤: {e}")
             time.sleep(1)
@@ -183,27 +741,56 @@ def background_learning_task():
                     continue
 
                 for f_name in os.listdir(materials_dir):
-                    if f_name.endswith(".pdf") and f_name not in imported:
+                    if f_name.endswith(".pdf") and f_name not in imported and learn_retry_due(f_name):
                         print(f"📚 正在研讀新教材：{f_name}...")
                         path = os.path.join(materials_dir, f_name)
                         
-                        with open(path, 'rb') as f:
-                            text = extract_text_from_pdf(f)
+                        meta = parse_curriculum_metadata(f_name)
+                        chunk_count = 0
+                        try:
+                            # 先完整擷取整份 PDF (寫入磁碟快取)，擷取失敗就不會呼叫任何向量化；
+                            # 之後逐頁向量化只讀快取，重試時也不必重新解析
+                            ensure_extracted(path, extractor="pypdf", skip_failed_pages=False)
+                            # 每頁的片段一起提交；上次中斷時已提交的頁面直接略過，不重複向量化也不重複寫入
+                            cur.execute("SELECT COALESCE(MAX(page), 0), COUNT(*) FROM teaching_materials WHERE filename = %s", (f_name,))
+                            done_page, chunk_count = cur.fetchone()
+                            if done_page:
+                                print(f"↪️ 從第 {done_page + 1} 頁接續研讀：{f_name}")
+                            for page_num, text in iter_pdf_pages(path):
+                                if page_num <= done_page:
+                                    continue
+                                for chunk in chunk_page_text(text):
+                                    if not chunk:
+                                        continue
+                                    vec = get_embedding(chunk)
+                                    if not vec:
+                                        # Gemini 斷路或重試用盡：這一頁整頁不提交，下次從這一頁重來
+                                        raise RuntimeError(f"第 {page_num} 頁片段無法向量化")
+                                    cur.execute(
+                                        """INSERT INTO teaching_materials (content, embedding, filename, course, chapter, doc_type, page)
+                                           VALUES (%s, %s, %s, %s, %s, %s, %s)""",
+                                        (chunk, vec, f_name, meta["course"], meta["chapter"], meta["doc_type"], page_num)
+                                    )
+                                    chunk_count += 1
+                                    time.sleep(0.5)
+                                conn.commit()
+                        except Exception as e:
+                            # 解析或向量化到一半失敗：不標記為已研讀，等待一段時間後從未完成的頁面接續
+                            conn.rollback()
+                            count, delay = record_learn_failure(f_name)
+                            if count >= LEARN_MAX_ATTEMPTS:
+                                print(f"🛑 連續 {count} 次研讀失敗，放棄: {f_name} ({e})")
+                            else:
+                                print(f"❌ 研讀中斷 (第 {count} 次)，{delay} 秒後重試: {f_name} ({e})")
+                            continue
                         
-                        if not text.strip(): continue
-                        
-                        chunks = [text[i:i+1000] for i in range(0, len(text), 1000)]
-                        for chunk in chunks:
-                            vec = get_embedding(chunk)
-                            if vec:
-                                cur.execute(
-                                    "INSERT INTO teaching_materials (content, embedding, filename) VALUES (%s, %s, %s)",
-                                    (chunk, vec, f_name)
-                                )
-                                time.sleep(0.5)
+                        if not chunk_count:
+                            conn.rollback()
+                            continue
                         
                         cur.execute("INSERT INTO imported_files (filename) VALUES (%s)", (f_name,))
                         conn.commit()
+                        _learn_failures.pop(f_name, None)
                         print(f"✅ {f_name} 研讀完畢！")
                 
                 cur.close()
@@ -213,52 +800,806 @@ def background_learning_task():
             
             time.sleep(60)
 
-threading.Thread(target=background_learning_task, daemon=True).start()
+# 離線工具 (例如 evaluate_retrieval.py) 匯入本模組時可設 BACKGROUND_LEARNING=0 關閉
+if os.environ.get('BACKGROUND_LEARNING', '1') != '0':
+    threading.Thread(target=background_learning_task, daemon=True).start()
+
+# ==========================================
+# [個人化] 學生目前的課程 / 章節 (用於過濾搜尋範圍)
+# ==========================================
+# 每個 worker 各自快取 USER_FILTERS_TTL 秒 (其他 worker 處理 !course 後，最慢這麼久就會讀到新設定)，
+# 最多保留 USER_FILTERS_CACHE_LIMIT 人 (LRU)
+USER_FILTERS_TTL = int(os.environ.get('USER_FILTERS_TTL', 60))   # (秒)
+USER_FILTERS_CACHE_LIMIT = 5000
+
+_user_filters_lock = threading.Lock()
+_user_filters = OrderedDict()   # user_id → (filters, 載入時間)
+
+USER_FILTERS_SQL = "SELECT course, chapter FROM user_preferences WHERE user_id = %s"
+
+def cached_user_filters(user_id):
+    """回傳快取中的課程設定；尚未載入或已過期時回傳 None"""
+    with _user_filters_lock:
+        entry = _user_filters.get(user_id)
+        if entry is None or time.monotonic() - entry[1] > USER_FILTERS_TTL:
+            return None
+        _user_filters.move_to_end(user_id)
+        return entry[0]
+
+def _store_user_filters(user_id, filters):
+    with _user_filters_lock:
+        _user_filters[user_id] = (filters, time.monotonic())
+        _user_filters.move_to_end(user_id)
+        while len(_user_filters) > USER_FILTERS_CACHE_LIMIT:
+            _user_filters.popitem(last=False)
+    return filters
+
+def cache_user_filters(user_id, row):
+    return _store_user_filters(user_id, {"course": row[0], "chapter": row[1]} if row else {})
+
+def get_user_filters(user_id):
+    cached = cached_user_filters(user_id)
+    if cached is not None:
+        return cached
+    try:
+        with pooled_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(USER_FILTERS_SQL, (user_id,))
+            row = cur.fetchone()
+            cur.close()
+    except Exception as e:
+        print(f"⚠️ 讀取課程設定失敗: {e}")
+        return {}
+    return cache_user_filters(user_id, row)
+
+def set_user_filters(user_id, course, chapter):
+    with pooled_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            INSERT INTO user_preferences (user_id, course, chapter, updated_at) VALUES (%s, %s, %s, NOW())
+            ON CONFLICT (user_id) DO UPDATE SET course = EXCLUDED.course, chapter = EXCLUDED.chapter, updated_at = NOW();
+        """, (user_id, course, chapter))
+        conn.commit()
+        cur.close()
+    _store_user_filters(user_id, {"course": course, "chapter": chapter} if course or chapter else {})
+
+def handle_course_command(user_id, text):
+    """!course 選修II 5 → 設定課程與章節；!course off → 取消"""
+    args = text.split()[1:]
+    if not args:
+        current = get_user_filters(user_id)
+        if not current.get("course") and not current.get("chapter"):
+            return "目前搜尋全部教材。\n設定範例：!course 選修II 5"
+        chapter = f" 第{current['chapter']}章" if current.get("chapter") else ""
+        return f"目前課程：{current.get('course') or '不限'}{chapter}"
+    if args[0].lower() in ("off", "clear", "清除"):
+        set_user_filters(user_id, None, None)
+        return "已取消課程設定，之後會搜尋全部教材。"
+
+    course = normalize_course(args[0])
+    chapter = int(args[1]) if len(args) > 1 and args[1].isdigit() else None
+    if not course:
+        return f"看不懂課程「{args[0]}」，可用：{'、'.join(COURSE_SLUGS)}"
+    set_user_filters(user_id, course, chapter)
+    return f"✅ 已設定課程：{course}" + (f" 第{chapter}章" if chapter else "")
+
+# ==========================================
+# [流量防護] 相同問題合併處理 (Single-flight)
+# ==========================================
+# 老師在課堂上出題時，全班會在幾秒內送出相同的問題。
+# 同一時間內相同的輸入只計算一次，其餘請求等待並共用結果。
+# 合併範圍是單一程序內的執行緒，因此 Procfile 以 gthread worker 執行
+# (每個程序 GUNICORN_THREADS 條執行緒)；同步 worker 一次只處理一則請求，合併不會發生。
+COALESCE_WAIT_TIMEOUT = 180   # (秒) 跟隨者最多等待多久，逾時則自行計算
+COALESCE_STATS_LIMIT = 500    # 最多保留多少個 key 的統計
+
+class _InFlightCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+_inflight_lock = threading.Lock()
+_inflight_calls = {}
+coalesce_stats = OrderedDict()
+
+def normalize_question(text):
+    """正規化學生輸入 (全形/半形、空白)，作為合併的 key"""
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+def text_coalesce_key(text, filters=None, history=""):
+    """帶有對話脈絡的追問，只和脈絡完全相同的請求合併"""
+    scope = "|".join(f"{k}={v}" for k, v in sorted((filters or {}).items()) if v is not None)
+    if history:
+        scope += f"|ctx={hashlib.sha256(history.encode('utf-8')).hexdigest()[:16]}"
+    return f"text:{scope}:{normalize_question(text)}"
+
+def image_coalesce_key(img_data):
+    return f"image:{hashlib.sha256(img_data).hexdigest()}"
+
+def _record_fanout(key, followers):
+    """記錄每個 key 的合併次數 (呼叫端需持有 _inflight_lock)"""
+    stats = coalesce_stats.pop(key, None) or {"flights": 0, "shared": 0, "max_fanout": 0}
+    stats["flights"] += 1
+    stats["shared"] += followers
+    stats["max_fanout"] = max(stats["max_fanout"], followers + 1)
+    coalesce_stats[key] = stats
+    while len(coalesce_stats) > COALESCE_STATS_LIMIT:
+        coalesce_stats.popitem(last=False)
+
+def coalesce(key, compute):
+    """相同 key 同時只執行一次 compute()，其餘呼叫者共用其結果"""
+    with _inflight_lock:
+        call = _inflight_calls.get(key)
+        leader = call is None
+        if leader:
+            call = _inflight_calls[key] = _InFlightCall()
+        else:
+            call.followers += 1
+
+    if not leader:
+        if call.done.wait(COALESCE_WAIT_TIMEOUT):
+            if call.error is not None:
+                raise call.error
+            return call.result
+        print(f"⚠️ 合併請求等待逾時，改為獨立計算: {key[:40]}")
+        return compute()
+
+    try:
+        call.result = compute()
+        return call.result
+    except Exception as e:
+        call.error = e
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight_calls.pop(key, None)
+            _record_fanout(key, call.followers)
+        call.done.set()
+
+def coalesce_summary():
+    with _inflight_lock:
+        flights = sum(s["flights"] for s in coalesce_stats.values())
+        shared = sum(s["shared"] for s in coalesce_stats.values())
+        busiest = max(coalesce_stats.items(), key=lambda kv: kv[1]["max_fanout"], default=None)
+    summary = f"{flights} 次計算 / {shared} 次共用"
+    if busiest and busiest[1]["max_fanout"] > 1:
+        summary += f" (最大同時 {busiest[1]['max_fanout']} 人)"
+    return summary
+
+# ==========================================
+# [流量防護] Webhook 冪等處理 (避免 LINE 重送造成重複生成)
+# ==========================================
+# 處理太慢時 LINE 會重送同一事件；以 webhookEventId 去重。
+# 記憶體內保留一段時間窗，多個 worker 之間則透過 processed_events 表共享。
+EVENT_DEDUPE_WINDOW = int(os.environ.get('EVENT_DEDUPE_WINDOW', 3600))  # (秒)
+EVENT_DEDUPE_LIMIT = 10000
+EVENT_DB_CLEANUP_EVERY = 500
+
+_seen_events_lock = threading.Lock()
+_seen_events = OrderedDict()
+dedupe_stats = {"claimed": 0, "hits": 0, "redeliveries": 0}
+
+def _claim_event_in_memory(event_id, now):
+    with _seen_events_lock:
+        while _seen_events:
+            oldest_id, seen_at = next(iter(_seen_events.items()))
+            if now - seen_at < EVENT_DEDUPE_WINDOW and len(_seen_events) < EVENT_DEDUPE_LIMIT:
+                break
+            _seen_events.popitem(last=False)
+        if event_id in _seen_events:
+            return False
+        _seen_events[event_id] = now
+        return True
+
+CLAIM_EVENT_SQL = "INSERT INTO processed_events (event_id) VALUES (%s) ON CONFLICT DO NOTHING"
+CLEANUP_EVENTS_SQL = "DELETE FROM processed_events WHERE processed_at < NOW() - make_interval(secs => %s)"
+
+def _claim_event_in_db(event_id):
+    """回傳 False 表示其他 worker 已處理過；資料庫異常時放行 (以記憶體結果為準)"""
+    try:
+        with pooled_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(CLAIM_EVENT_SQL, (event_id,))
+            claimed = cur.rowcount == 1
+            if dedupe_stats["claimed"] % EVENT_DB_CLEANUP_EVERY == 0:
+                cur.execute(CLEANUP_EVENTS_SQL, (EVENT_DEDUPE_WINDOW,))
+            conn.commit()
+            cur.close()
+        return claimed
+    except Exception as e:
+        print(f"⚠️ 事件去重查詢失敗: {e}")
+        return True
+
+def event_identity(event):
+    """回傳 (webhookEventId, 是否為重送)，並記錄重送次數"""
+    event_id = getattr(event, "webhook_event_id", None)
+    delivery = getattr(event, "delivery_context", None)
+    is_redelivery = bool(getattr(delivery, "is_redelivery", False))
+    if is_redelivery:
+        dedupe_stats["redeliveries"] += 1
+    return event_id, is_redelivery
+
+def record_duplicate_event(event_id, is_redelivery):
+    dedupe_stats["hits"] += 1
+    print(f"🔁 略過重複事件: {event_id} (redelivery={is_redelivery})")
+
+def claim_webhook_event(event):
+    """第一次收到此事件時回傳 True；重複投遞則回傳 False"""
+    event_id, is_redelivery = event_identity(event)
+    if not event_id:
+        return True
+
+    if not _claim_event_in_memory(event_id, time.time()) or not _claim_event_in_db(event_id):
+        record_duplicate_event(event_id, is_redelivery)
+        return False
+
+    dedupe_stats["claimed"] += 1
+    return True
+
+# ==========================================
+# [對話記憶] 每位學生的近期對話 (追問不必重述題目)
+# ==========================================
+# 記憶體中每人保留最近 CONVERSATION_TURNS 輪 (deque 環形緩衝，回答只留前段)，
+# 超過輪數或 token 預算時，最舊的幾輪交給 Gemini 濃縮進摘要，prompt 長度維持固定上限
+# (摘要由獨立的摘要執行緒進行，不佔用 webhook 回應時間，也不拖慢紀錄執行緒的批次寫入)。
+# 追問 (「那如果速度加倍呢？」) 直接沿用上一輪檢索到的教材，不再重新 Embedding + 搜尋。
+# 狀態由紀錄執行緒批次寫入 conversation_state 表：換 worker、重新部署或被擠出記憶體快取後仍可接續。
+# 多個 worker 都可能處理同一位學生：本 worker 沒有未寫入的變動時，每 CONVERSATION_RECHECK_SECONDS 秒
+# 對照一次資料庫，資料庫較新 (其他 worker 寫入) 就改用資料庫版本，避免各自覆蓋。
+CONVERSATION_TURNS = int(os.environ.get('CONVERSATION_TURNS', 6))
+CONVERSATION_TOKEN_BUDGET = int(os.environ.get('CONVERSATION_TOKEN_BUDGET', 1500))
+CONVERSATION_IDLE_SECONDS = int(os.environ.get('CONVERSATION_IDLE_SECONDS', 1800))  # 閒置多久視為新話題
+CONVERSATION_RECHECK_SECONDS = int(os.environ.get('CONVERSATION_RECHECK_SECONDS', 10))
+CONVERSATION_CACHE_USERS = 1000      # 記憶體最多保留幾位學生
+CONVERSATION_RETENTION_DAYS = 30     # conversation_state 保留天數
+ANSWER_KEEP_CHARS = 400              # 每輪回答只保留前段 (結論通常在前面)
+SUMMARY_MAX_CHARS = 300
+SUMMARY_MODEL = 'gemini-2.5-flash'
+SUMMARY_TIMEOUT = float(os.environ.get('SUMMARY_TIMEOUT', 15))   # 單次摘要逾時 (秒)，逾時改用簡易摘要
+SUMMARY_BATCH = int(os.environ.get('SUMMARY_BATCH', 20))         # 每輪最多摘要幾位學生，其餘留到下一輪
+SUMMARY_PROMPT = "請把以下物理課對話整理成 {limit} 字以內的摘要，保留題目條件、數值與已得到的結論，只輸出摘要："
+
+# 只有明確指向前文，或很短的省略句 (「那如果速度加倍呢？」) 才視為追問；
+# 「為什麼…」「如果…」開頭的完整新題目會重新檢索
+FOLLOWUP_REFERENCES = ("剛剛", "剛才", "上一題", "上題", "這題", "同一題", "承上", "接續剛")
+FOLLOWUP_ELLIPTICAL_PREFIXES = ("那", "然後", "所以", "還有", "接著")
+FOLLOWUP_MAX_CHARS = 15
+
+class Conversation:
+    __slots__ = ("turns", "summary", "materials", "filters", "updated_at", "epoch", "checked_at")
+
+    def __init__(self, turns=(), summary="", materials=(), filters=None, updated_at=0.0):
+        self.turns = deque(turns, maxlen=CONVERSATION_TURNS)   # (問題, 回答前段)
+        self.summary = summary
+        self.materials = tuple(materials)                       # 上一輪的 (content, filename, page)
+        self.filters = filters or {}
+        self.updated_at = updated_at
+        self.epoch = 0      # 每次清除 (!new / 閒置) 或改用資料庫版本時加一，背景摘要完成時用來確認對話沒被重置
+        self.checked_at = 0.0   # 上次對照資料庫的 time.monotonic()
+
+    def reset(self):
+        self.turns.clear()
+        self.summary = ""
+        self.epoch += 1
+
+    def replace_with(self, other):
+        """改用其他 worker 寫入的較新狀態 (進行中的背景摘要因 epoch 改變而作廢)"""
+        self.turns = other.turns
+        self.summary = other.summary
+        self.materials = other.materials
+        self.filters = other.filters
+        self.updated_at = other.updated_at
+        self.epoch += 1
+
+    def snapshot(self):
+        return (self.summary, list(self.turns), [list(r) for r in self.materials], self.filters, self.updated_at)
+
+_conversations_lock = threading.Lock()
+_conversations = OrderedDict()   # user_id → Conversation (LRU)
+_dirty_conversations = {}        # user_id → snapshot，等待寫入資料庫
+_pending_summaries = {}          # user_id → (Conversation, epoch, 被擠出的舊對話)，等待背景摘要
+# 摘要專用 client：逾時比一般回答短，卡住時很快退回簡易摘要
+summary_client = genai.Client(
+    api_key=GOOGLE_API_KEY,
+    http_options=types.HttpOptions(timeout=int(SUMMARY_TIMEOUT * 1000))  # (毫秒)
+)
+conversation_stats = {"reused": 0, "retrieved": 0, "summarized": 0}
+
+LOAD_CONVERSATION_SQL = "SELECT summary, turns, materials, filters, updated_at FROM conversation_state WHERE user_id = %s"
+CLEANUP_CONVERSATIONS_SQL = "DELETE FROM conversation_state WHERE updated_at < NOW() - make_interval(days => %s)"
+
+_CJK_CHAR = re.compile(rf"[{_CJK}]")
+
+def estimate_tokens(text):
+    """粗估 token 數：中日韓字元約一字一 token，其餘約四字元一 token"""
+    cjk = len(_CJK_CHAR.findall(text))
+    return cjk + (len(text) - cjk) // 4
+
+def _history_tokens(convo):
+    return estimate_tokens(convo.summary) + sum(estimate_tokens(q) + estimate_tokens(a) for q, a in convo.turns)
+
+_PUNCTUATION = re.compile(r"[\s\W_]+")
+
+def is_followup(text):
+    question = normalize_question(text)
+    if any(ref in question for ref in FOLLOWUP_REFERENCES):
+        return True
+    core = _PUNCTUATION.sub("", question)
+    return len(core) <= FOLLOWUP_MAX_CHARS and (core.startswith(FOLLOWUP_ELLIPTICAL_PREFIXES) or core.endswith("呢"))
+
+def _conversation_from_state(summary, turns, materials, filters, updated_at):
+    return Conversation(
+        turns=[tuple(t) for t in turns or []],
+        summary=summary or "",
+        materials=[tuple(m) for m in materials or []],
+        filters=filters,
+        updated_at=updated_at,
+    )
+
+def _load_conversation(user_id):
+    """從資料庫讀取；沒有紀錄或資料庫不可用時回傳空白對話 (updated_at 為 0，不會比記憶體版本新)"""
+    try:
+        with pooled_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(LOAD_CONVERSATION_SQL, (user_id,))
+            row = cur.fetchone()
+            cur.close()
+    except Exception as e:
+        print(f"⚠️ 讀取對話紀錄失敗: {e}")
+        row = None
+    if not row:
+        return Conversation()
+    summary, turns, materials, filters, updated_at = row
+    return _conversation_from_state(summary, turns, materials, filters, updated_at.timestamp() if updated_at else 0.0)
+
+def _unsaved_conversation(user_id):
+    """本 worker 尚未寫入資料庫的狀態 (等待摘要的對話物件，或等待寫入的快照)；沒有時回傳 None"""
+    pending = _pending_summaries.get(user_id)
+    if pending:
+        return pending[0]
+    snapshot = _dirty_conversations.get(user_id)
+    if snapshot:
+        return _conversation_from_state(*snapshot)
+    return None
+
+def get_conversation(user_id):
+    now = time.monotonic()
+    with _conversations_lock:
+        convo = _conversations.get(user_id)
+        if convo is None:
+            # 被擠出記憶體快取但變動還沒寫入：以本機狀態為準，不讀資料庫的舊版本
+            convo = _unsaved_conversation(user_id)
+            if convo is not None:
+                convo.checked_at = now
+                _conversations[user_id] = convo
+        else:
+            _conversations.move_to_end(user_id)
+        if convo is not None and (
+                user_id in _dirty_conversations or user_id in _pending_summaries
+                or now - convo.checked_at < CONVERSATION_RECHECK_SECONDS):
+            return convo
+
+    latest = _load_conversation(user_id)
+    with _conversations_lock:
+        cached = _conversations.get(user_id)
+        if cached is None:
+            convo = _conversations[user_id] = latest
+        else:
+            convo = cached
+            if latest.updated_at > convo.updated_at:
+                convo.replace_with(latest)   # 其他 worker 在這之後處理過這位學生
+        convo.checked_at = now
+        _conversations.move_to_end(user_id)
+        while len(_conversations) > CONVERSATION_CACHE_USERS:
+            _conversations.popitem(last=False)   # 狀態已在 _dirty_conversations / 資料庫中
+    return convo
+
+def format_history(convo):
+    parts = []
+    if convo.summary:
+        parts.append(f"【先前對話摘要】\n{convo.summary}")
+    if convo.turns:
+        parts.append("【最近對話】\n" + "\n".join(f"學生：{q}\n助教：{a}" for q, a in convo.turns))
+    return "\n\n".join(parts)
+
+def conversation_context(user_id, text, filters=None):
+    """
+    回傳 (對話脈絡文字, 可沿用的教材)。
+    追問且搜尋範圍沒變時沿用上一輪教材；否則教材為 None，由呼叫端重新檢索。
+    """
+    convo = get_conversation(user_id)
+    with _conversations_lock:
+        if time.time() - convo.updated_at > CONVERSATION_IDLE_SECONDS:
+            history = ""
+        else:
+            history = format_history(convo)
+            if convo.materials and convo.filters == (filters or {}) and is_followup(text):
+                conversation_stats["reused"] += 1
+                return history, list(convo.materials)
+    conversation_stats["retrieved"] += 1
+    return history, None
+
+def summarize_turns(summary, turns, use_model=True):
+    """把舊摘要與被擠出的對話濃縮成新摘要；Gemini 不可用 (或 use_model=False) 時退回只保留學生問題"""
+    transcript = "\n".join(f"學生：{q}\n助教：{a}" for q, a in turns)
+    if summary:
+        transcript = f"(先前摘要) {summary}\n{transcript}"
+    fallback = " / ".join(filter(None, [summary] + [q for q, _ in turns]))[-SUMMARY_MAX_CHARS:]
+    if not use_model:
+        return fallback
+    try:
+        response = gemini_breaker.call(
+            summary_client.models.generate_content,
+            model=SUMMARY_MODEL,
+            contents=SUMMARY_PROMPT.format(limit=SUMMARY_MAX_CHARS) + "\n" + transcript
+        )
+        conversation_stats["summarized"] += 1
+        return (response.text or "").strip()[:SUMMARY_MAX_CHARS]
+    except Exception as e:
+        print(f"⚠️ 對話摘要失敗，改為保留問題清單: {e}")
+        return fallback
+
+def remember_turn(user_id, question, answer, materials=None, filters=None):
+    """記錄一輪問答；被擠出的舊對話交給摘要執行緒，這裡不呼叫 Gemini"""
+    convo = get_conversation(user_id)
+    folded = []
+    with _conversations_lock:
+        if time.time() - convo.updated_at > CONVERSATION_IDLE_SECONDS:
+            convo.reset()
+            _pending_summaries.pop(user_id, None)
+        while len(convo.turns) >= CONVERSATION_TURNS:
+            folded.append(convo.turns.popleft())
+        convo.turns.append((question, answer[:ANSWER_KEEP_CHARS]))
+        while len(convo.turns) > 1 and _history_tokens(convo) > CONVERSATION_TOKEN_BUDGET:
+            folded.append(convo.turns.popleft())
+        if materials is not None:
+            convo.materials = tuple(tuple(r) for r in materials)
+        convo.filters = filters or {}
+        convo.updated_at = time.time()
+        if folded:
+            pending = _pending_summaries.get(user_id)
+            if pending and pending[0] is convo and pending[1] == convo.epoch:
+                pending[2].extend(folded)
+            else:
+                _pending_summaries[user_id] = (convo, convo.epoch, folded)
+        _dirty_conversations[user_id] = convo.snapshot()
+
+def summarize_pending_conversations(use_model=True, limit=None):
+    """把等待中的舊對話併入摘要 (由摘要執行緒呼叫)；limit 為這一輪最多處理幾位，其餘 (較晚排入的) 留到下一輪"""
+    with _conversations_lock:
+        user_ids = list(_pending_summaries)[:limit]
+        pending = {user_id: _pending_summaries.pop(user_id) for user_id in user_ids}
+    for user_id, (convo, epoch, folded) in pending.items():
+        with _conversations_lock:
+            previous_summary = convo.summary
+        summary = summarize_turns(previous_summary, folded, use_model)
+        with _conversations_lock:
+            # 期間沒有被 !new 清除、閒置重置或改用資料庫版本，且沒有被重新載入成另一個物件
+            if convo.epoch == epoch and _conversations.get(user_id, convo) is convo:
+                convo.summary = summary
+                _dirty_conversations[user_id] = convo.snapshot()
+    return len(pending)
+
+def clear_conversation(user_id):
+    convo = get_conversation(user_id)
+    with _conversations_lock:
+        convo.reset()
+        convo.materials = ()
+        convo.updated_at = time.time()
+        _pending_summaries.pop(user_id, None)
+        _dirty_conversations[user_id] = convo.snapshot()
+    return "🆕 已開始新的對話，先前的題目不再列入參考。"
+
+def flush_conversations():
+    """把有變動的對話狀態批次寫入資料庫 (由紀錄執行緒呼叫)"""
+    with _conversations_lock:
+        if not _dirty_conversations:
+            return 0
+        pending = dict(_dirty_conversations)
+        _dirty_conversations.clear()
+    rows = [
+        (user_id, summary, Json(turns), Json(materials), Json(filters), datetime.fromtimestamp(updated_at).astimezone())
+        for user_id, (summary, turns, materials, filters, updated_at) in pending.items()
+    ]
+    try:
+        with pooled_connection() as conn:
+            cur = conn.cursor()
+            execute_values(cur, """
+                INSERT INTO conversation_state (user_id, summary, turns, materials, filters, updated_at)
+                VALUES %s
+                ON CONFLICT (user_id) DO UPDATE SET
+                    summary = EXCLUDED.summary, turns = EXCLUDED.turns, materials = EXCLUDED.materials,
+                    filters = EXCLUDED.filters, updated_at = EXCLUDED.updated_at;
+            """, rows)
+            conn.commit()
+            cur.close()
+    except Exception as e:
+        print(f"❌ 對話狀態寫入失敗: {e}")
+        with _conversations_lock:
+            for user_id, snapshot in pending.items():
+                _dirty_conversations.setdefault(user_id, snapshot)
+        return 0
+    return len(rows)
 
 # ==========================================
 # [商業核心] 雙重紀錄系統
 # ==========================================
+# 每次互動先放進佇列，由背景執行緒批次寫入 (Sheet 用 append_rows、DB 用 execute_values)
+LOG_FLUSH_INTERVAL = 5     # (秒)
+LOG_FLUSH_BATCH = 200
+LOG_RETRY_LIMIT = 5000     # 資料庫寫入失敗時最多暫存幾筆等待重試
+_log_queue = queue.Queue()
+_log_db_retry = deque()    # Sheet 已寫入、資料庫寫入失敗的紀錄 (重試時只寫資料庫，避免 Sheet 重複)
+
 def log_interaction(user_id, user_name, m_type, input_text, output_text):
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    
+    _log_queue.put((datetime.now().astimezone(), user_id, user_name, m_type, input_text, output_text))
+
+def flush_logs():
+    batch = []
+    while len(batch) < LOG_FLUSH_BATCH:
+        try:
+            batch.append(_log_queue.get_nowait())
+        except queue.Empty:
+            break
+    if not batch:
+        if _log_db_retry:
+            _write_log_rows(_log_db_retry)
+        return 0
+
     if google_sheet:
         try:
-            google_sheet.append_row([timestamp, user_id, user_name, m_type, input_text, output_text])
+            sheets_breaker.call(google_sheet.append_rows, [
+                [ts.strftime("%Y-%m-%d %H:%M:%S"), *rest] for ts, *rest in batch
+            ])
+        except CircuitOpenError:
+            print(f"⏭️ Sheet 斷路中，略過 {len(batch)} 筆 (資料庫照常寫入)")
         except Exception as e:
             print(f"❌ Sheet 寫入失敗: {e}")
 
+    if not _write_log_rows(_log_db_retry + deque(batch)):
+        _log_db_retry.extend(batch)
+        dropped = 0
+        while len(_log_db_retry) > LOG_RETRY_LIMIT:
+            _log_db_retry.popleft()
+            dropped += 1
+        if dropped:
+            print(f"⚠️ 待重試紀錄超過 {LOG_RETRY_LIMIT} 筆，捨棄最舊的 {dropped} 筆")
+    return len(batch)
+
+def _write_log_rows(rows):
+    """寫入資料庫；成功時清空待重試紀錄並回傳 True"""
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO system_logs (user_id, user_name, message_type, input_content, output_content)
-            VALUES (%s, %s, %s, %s, %s)
-        """, (user_id, user_name, m_type, input_text, output_text))
-        conn.commit()
-        cur.close()
-        conn.close()
+        with pooled_connection() as conn:
+            cur = conn.cursor()
+            execute_values(cur, """
+                INSERT INTO system_logs (timestamp, user_id, user_name, message_type, input_content, output_content)
+                VALUES %s
+            """, list(rows))
+            conn.commit()
+            cur.close()
     except Exception as e:
-        print(f"❌ DB Log 寫入失敗: {e}")
+        print(f"❌ DB Log 寫入失敗，{len(rows)} 筆稍後重試: {e}")
+        return False
+    _log_db_retry.clear()
+    return True
+
+def log_flush_task():
+    while True:
+        time.sleep(LOG_FLUSH_INTERVAL)
+        while flush_logs() == LOG_FLUSH_BATCH:
+            pass
+        flush_conversations()
+
+def conversation_summary_task():
+    """對話摘要獨立一條執行緒：Gemini 變慢時只延後摘要，不影響紀錄與對話狀態的寫入"""
+    while True:
+        time.sleep(LOG_FLUSH_INTERVAL)
+        summarize_pending_conversations(limit=SUMMARY_BATCH)
+
+def flush_all_logs():
+    while flush_logs():
+        pass
+    # 程序結束時不等 Gemini，改用只保留學生問題的簡易摘要
+    summarize_pending_conversations(use_model=False)
+    flush_conversations()
+
+threading.Thread(target=log_flush_task, daemon=True).start()
+threading.Thread(target=conversation_summary_task, daemon=True).start()
+atexit.register(flush_all_logs)
 
 # ==========================================
 # [邏輯核心] 對話處理 (SDK 更新版)
 # ==========================================
-def search_knowledge_base(query, top_k=3):
+def search_by_vector(vec, top_k=3, mode=VECTOR_STORAGE, dim=COMPACT_DIMENSION, candidates=RERANK_CANDIDATES, filters=None):
+    """以查詢向量檢索教材，回傳 [(content, filename, page), ...]；查詢組裝見 vector_storage.py"""
+    with pooled_connection() as conn:
+        return run_search(conn, vec, top_k, mode, dim, candidates, filters)
+
+def retrieve_materials(query, top_k=3, filters=None):
+    """資料庫斷路或查詢失敗時回傳空結果，讓回答降級為不引用教材"""
+    if db_breaker.is_open:
+        return []
     vec = get_embedding(query)
-    if not vec: return ""
+    if not vec: return []
+    try:
+        rows = search_by_vector(vec, top_k, filters=filters)
+        if filters and not rows:
+            # 指定的課程/章節還沒有教材時，退回全部教材
+            rows = search_by_vector(vec, top_k)
+    except CircuitOpenError:
+        return []
+    except psycopg2.Error as e:
+        # 連線中斷 / 查詢逾時已由 pooled_connection() 計入資料庫斷路器
+        print(f"⚠️ 教材檢索失敗，改為不引用教材回答: {e}")
+        return []
+    return rows
+
+def format_source(filename, page):
+    return f"{filename} 第{page}頁" if page else filename
+
+def format_knowledge(rows):
+    if not rows: return ""
+    return "\n\n".join([f"【參考資料:{format_source(r[1], r[2])}】\n{r[0]}" for r in rows])
+
+def search_knowledge_base(query, top_k=3, filters=None):
+    return format_knowledge(retrieve_materials(query, top_k, filters))
+
+def build_text_prompt(text, knowledge_context, history=""):
+    if history:
+        history = f"以下是你與這位學生先前的對話，學生的問題可能是延續先前的題目：\n{history}\n"
+    return f"""
+    你是一位專業物理助教。
+    {history}
+    請參考以下資料庫中的教材回答問題 (若有相關內容)：
+    {knowledge_context}
     
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT content, filename FROM teaching_materials
-        ORDER BY embedding <=> %s::vector LIMIT %s;
-    """, (vec, top_k))
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
+    學生問題：{text}
+    """
+
+def answer_text_question(text, filters=None, history="", materials=None):
+    """回傳 (回答, 引用的教材)；materials 不為 None 時直接沿用 (追問)，不重新檢索"""
+    if materials is None:
+        materials = retrieve_materials(text, filters=filters)
+    prompt = build_text_prompt(text, format_knowledge(materials), history)
     
-    if not rows: return ""
-    return "\n\n".join([f"【參考資料:{r[1]}】\n{r[0]}" for r in rows])
+    # [更新] 新版生成語法
+    response = gemini_breaker.call(
+        gemini_client.models.generate_content,
+        model=TEXT_MODEL,
+        contents=prompt
+    )
+    return response.text, materials
+
+def answer_image_question(img_data):
+    # [更新] 直接將 bytes 封裝成 Part 物件
+    image_part = types.Part.from_bytes(data=img_data, mime_type="image/jpeg")
+    
+    response = gemini_breaker.call(
+        gemini_client.models.generate_content,
+        model=IMAGE_MODEL,
+        contents=[IMAGE_PROMPT, image_part]
+    )
+    return response.text
+
+# ==========================================
+# [穩定性] 健康檢查與暖機 (/healthz、/readyz)
+# ==========================================
+# 背景執行緒每 HEALTH_CHECK_INTERVAL 秒實際量測一次各依賴，端點只讀取快取結果，
+# 負載平衡器可以頻繁輪詢而不會打到資料庫或 API。
+# 啟動後第一輪檢查同時就是暖機：建立連線池、pgvector 查詢 (載入索引)、Embedding 來回、LINE 連線。
+# 四項都成功過一次才算 ready；之後個別依賴故障時由斷路器降級處理，/readyz 回報 degraded 但不摘除。
+HEALTH_CHECK_INTERVAL = int(os.environ.get('HEALTH_CHECK_INTERVAL', 60))  # (秒)
+HEALTH_PROBE_TEXT = "牛頓第二運動定律"
+READINESS_CHECKS = ("database", "pgvector", "embedding", "line")
+HEALTH_LABELS = {"database": "資料庫", "pgvector": "向量檢索", "embedding": "Embedding", "line": "LINE API"}
+
+_health_lock = threading.Lock()
+health_state = {"ready": False, "checked_at": None, "checks": {}}
+
+def timed_check(fn):
+    """執行一項檢查，回傳 {"ok", "latency_ms", "error"?}"""
+    started = time.perf_counter()
+    try:
+        fn()
+        result = {"ok": True}
+    except Exception as e:
+        result = {"ok": False, "error": str(e)[:200]}
+    result["latency_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return result
+
+def record_health(checks):
+    """儲存一輪檢查結果 (同步與非同步模式共用)"""
+    ok = all(checks.get(name, {}).get("ok") for name in READINESS_CHECKS)
+    with _health_lock:
+        if ok and not health_state["ready"]:
+            print("✅ 暖機完成，開始接受流量: " + ", ".join(f"{n} {checks[n]['latency_ms']} ms" for n in READINESS_CHECKS))
+        health_state["ready"] = health_state["ready"] or ok
+        health_state["checked_at"] = time.time()
+        health_state["checks"] = checks
+
+def _check_database():
+    with pooled_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT 1")
+        cur.fetchone()
+        cur.close()
+
+def run_health_checks():
+    checks = {"database": timed_check(_check_database)}
+
+    probe = {}
+    def check_embedding():
+        response = gemini_breaker.call(gemini_client.models.embed_content, model=EMBEDDING_MODEL, contents=HEALTH_PROBE_TEXT)
+        probe["vec"] = response.embeddings[0].values
+    checks["embedding"] = timed_check(check_embedding)
+
+    def check_pgvector():
+        if "vec" not in probe:
+            raise RuntimeError("需要 Embedding 結果才能測試")
+        search_by_vector(probe["vec"], top_k=1)
+    checks["pgvector"] = timed_check(check_pgvector)
+
+    checks["line"] = timed_check(line_bot_api.get_bot_info)
+    record_health(checks)
+    return checks
+
+def health_check_task():
+    while True:
+        run_health_checks()
+        time.sleep(HEALTH_CHECK_INTERVAL)
+
+def readiness():
+    """回傳 (是否 ready, 內容)；只讀快取"""
+    with _health_lock:
+        checks = dict(health_state["checks"])
+        ready = health_state["ready"]
+        checked_at = health_state["checked_at"]
+    degraded = [name for name, result in checks.items() if not result.get("ok")]
+    return ready, {
+        "status": ("degraded" if degraded else "ready") if ready else "warming_up",
+        "checked_seconds_ago": round(time.time() - checked_at, 1) if checked_at else None,
+        "checks": checks,
+        "breakers": {b.name: b.state for b in BREAKERS},
+    }
+
+def health_summary():
+    with _health_lock:
+        checks = health_state["checks"]
+        checked_at = health_state["checked_at"]
+    if not checked_at:
+        return "  (暖機中，尚未完成第一次檢查)"
+    lines = []
+    for name in READINESS_CHECKS:
+        result = checks.get(name, {})
+        mark = "✅" if result.get("ok") else "❌"
+        lines.append(f"  {HEALTH_LABELS[name]}: {mark} {result.get('latency_ms', '-')} ms")
+    lines.append(f"  ({time.time() - checked_at:.0f} 秒前量測)")
+    return "\n".join(lines)
+
+def status_report():
+    sheet_status = "✅ 連線中" if google_sheet else "❌ 未連線"
+    return f"📊 系統狀態報告 (v2.0 GenAI)\nGoogle Sheet: {sheet_status}\n依賴延遲:\n{health_summary()}\n斷路器:\n{breaker_summary()}\n合併請求: {coalesce_summary()}\n重送去重: {dedupe_stats['hits']} 次 (重送 {dedupe_stats['redeliveries']} 次)\n對話記憶: 追問沿用教材 {conversation_stats['reused']} 次 / 重新檢索 {conversation_stats['retrieved']} 次 / 摘要 {conversation_stats['summarized']} 次\nSDK: google-genai\n\n我是你的全能物理助教！"
+
+@app.route("/healthz", methods=['GET'])
+def healthz():
+    """存活檢查：程序能回應即可，不檢查任何依賴"""
+    return jsonify({"status": "ok"})
+
+@app.route("/readyz", methods=['GET'])
+def readyz():
+    ready, body = readiness()
+    return jsonify(body), (200 if ready else 503)
+
+@app.route("/stats", methods=['GET'])
+def stats():
+    if not STATS_TOKEN:
+        abort(404)
+    if request.headers.get('Authorization') != f"Bearer {STATS_TOKEN}":
+        abort(403)
+    days = min(max(request.args.get('days', 7, type=int), 1), 366)
+    return jsonify(get_usage_stats(days))
 
 @app.route("/callback", methods=['POST'])
 def callback():
@@ -272,19 +1613,21 @@ def callback():
 
 @handler.add(MessageEvent, message=(TextMessageContent, ImageMessageContent, AudioMessageContent))
 def handle_message(event):
+    if not claim_webhook_event(event):
+        return
+
     user_id = event.source.user_id
     
     user_name = "Unknown"
     try:
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            profile = line_bot_api.get_profile(user_id)
-            user_name = profile.display_name
+        profile = line_bot_api.get_profile(user_id)
+        user_name = profile.display_name
     except: pass
 
     m_type = event.message.type
     final_response = "（思考中...）"
     user_log_content = ""
+    turn = None
 
     try:
         # A. 文字處理 (使用新版 generate_content)
@@ -293,99 +1636,90 @@ def handle_message(event):
             user_log_content = text
             
             if text == "!status":
-                sheet_status = "✅ 連線中" if google_sheet else "❌ 未連線"
-                final_response = f"📊 系統狀態報告 (v2.0 GenAI)\nGoogle Sheet: {sheet_status}\n資料庫: 正常\nSDK: google-genai\n\n我是你的全能物理助教！"
+                final_response = status_report()
+            elif text.startswith("!course"):
+                final_response = handle_course_command(user_id, text)
+            elif text == "!new":
+                final_response = clear_conversation(user_id)
             else:
-                knowledge_context = search_knowledge_base(text)
-                prompt = f"""
-                你是一位專業物理助教。
-                請參考以下資料庫中的教材回答問題 (若有相關內容)：
-                {knowledge_context}
-                
-                學生問題：{text}
-                """
-                
-                # [更新] 新版生成語法
-                response = gemini_client.models.generate_content(
-                    model='gemini-2.5-pro',
-                    contents=prompt
+                filters = get_user_filters(user_id)
+                history, materials = conversation_context(user_id, text, filters)
+                final_response, materials = coalesce(
+                    text_coalesce_key(text, filters, history),
+                    lambda: answer_text_question(text, filters, history, materials)
                 )
-                final_response = response.text
+                turn = (text, final_response, materials, filters)
 
         # B. 圖片處理 (使用新版 Bytes 處理)
         elif m_type == 'image':
             user_log_content = "(傳送圖片)"
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                msg_content = line_bot_api.get_message_content(event.message.id)
-                img_data = msg_content.read()
-                
-                # [更新] 直接將 bytes 封裝成 Part 物件
-                image_part = types.Part.from_bytes(data=img_data, mime_type="image/jpeg")
-                
-                response = gemini_client.models.generate_content(
-                    model='gemini-2.5-flash-image',
-                    contents=["這是一題物理題目，請幫我詳細解題：", image_part]
-                )
-                final_response = response.text
+            msg_content = line_bot_api.get_message_content(event.message.id)
+            img_data = msg_content.read()
+            
+            final_response = coalesce(image_coalesce_key(img_data), lambda: answer_image_question(img_data))
 
         # C. 語音處理 (使用新版 File Upload)
         elif m_type == 'audio':
             user_log_content = "(傳送語音)"
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                msg_content = line_bot_api.get_message_content(event.message.id)
+            msg_content = line_bot_api.get_message_content(event.message.id)
+
+            with tempfile.NamedTemporaryFile(suffix='.m4a', delete=False) as temp_file:
+                for chunk in msg_content.iter_content():
+                    temp_file.write(chunk)
+                temp_path = temp_file.name
+
+            try:
+                # [更新] 新版檔案上傳與生成
+                uploaded_file = gemini_breaker.call(gemini_client.files.upload, path=temp_path)
                 
-                with tempfile.NamedTemporaryFile(suffix='.m4a', delete=False) as temp_file:
-                    for chunk in msg_content.iter_content():
-                        temp_file.write(chunk)
-                    temp_path = temp_file.name
+                # 等待處理完成 (新版狀態檢查)
+                while uploaded_file.state.name == "PROCESSING":
+                    time.sleep(1)
+                    uploaded_file = gemini_client.files.get(name=uploaded_file.name)
 
-                try:
-                    # [更新] 新版檔案上傳與生成
-                    uploaded_file = gemini_client.files.upload(path=temp_path)
-                    
-                    # 等待處理完成 (新版狀態檢查)
-                    while uploaded_file.state.name == "PROCESSING":
-                        time.sleep(1)
-                        uploaded_file = gemini_client.files.get(name=uploaded_file.name)
-
-                    response = gemini_client.models.generate_content(
-                        model='gemini-2.5-flash',
-                        contents=["請回答這段語音的問題：", uploaded_file]
-                    )
-                    final_response = response.text
-                finally:
-                    if os.path.exists(temp_path):
-                        os.remove(temp_path)
+                response = gemini_breaker.call(
+                    gemini_client.models.generate_content,
+                    model=AUDIO_MODEL,
+                    contents=[AUDIO_PROMPT, uploaded_file]
+                )
+                final_response = response.text
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
 
         # 回覆 User
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
+        line_bot_api.reply_message(
+            ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TextMessage(text=final_response)]
+            )
+        )
+
+    except Exception as e:
+        logger.error(f"處理錯誤: {e}")
+        final_response = BUSY_MESSAGE
+        try:
             line_bot_api.reply_message(
                 ReplyMessageRequest(
                     reply_token=event.reply_token,
                     messages=[TextMessage(text=final_response)]
                 )
             )
+        except: pass
 
-    except Exception as e:
-        logger.error(f"處理錯誤: {e}")
-        final_response = "抱歉，系統目前忙碌中，請稍後再試。"
+    if turn and final_response != BUSY_MESSAGE:
         try:
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=final_response)]
-                    )
-                )
-        except: pass
+            remember_turn(user_id, *turn)
+        except Exception as e:
+            print(f"⚠️ 對話記憶更新失敗: {e}")
 
     log_interaction(user_id, user_name, m_type, user_log_content, final_response)
 
 initialize_database()
+threading.Thread(target=log_maintenance_task, daemon=True).start()
+# 非同步模式 (async_app.py) 與離線工具會關閉，改用自己的檢查
+if os.environ.get('HEALTH_CHECKS', '1') != '0':
+    threading.Thread(target=health_check_task, daemon=True).start()
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 10000))
@@ -0,0 +1,193 @@
+# 檔案：migrate_vector_storage.py
+#
+# ★★★ 壓縮向量索引遷移 + 召回率/延遲基準測試 ★★★
+#
+# 用法：
+#   python migrate_vector_storage.py --mode halfvec
+#   python migrate_vector_storage.py --mode binary --dim 768 --candidates 80
+#   python migrate_vector_storage.py --mode halfvec --dim 256 --benchmark-only
+#
+# 步驟：
+#   1. 以 CREATE INDEX CONCURRENTLY 為 teaching_materials / physics_vectors 建立壓縮運算式索引
+#      (不鎖表、不改動既有資料；完整 vector(768) 欄位保留作為精確重排序依據)
+#   2. 從資料表隨機抽樣已存在的向量作為查詢，與「完整精度暴力搜尋」比較
+#      recall@k 與延遲 (p50 / p95)；查詢向量本身那一列不計入 (否則 top-1 必定是自己，召回率偏高)
+#      這只衡量壓縮索引與精確搜尋的一致性；實際題目的檢索品質請用 evaluate_retrieval.py
+#   (另外為每個課程建立部分索引 WHERE course = '...'，學生指定課程時只掃描該課程的向量)
+#   3. 確認數字可接受後，在 Render 設定 VECTOR_STORAGE / COMPACT_DIMENSION 即完成切換；
+#      要回復只需把 VECTOR_STORAGE 改回 full，舊索引可用 --drop 移除
+
+import os
+import sys
+import time
+import argparse
+import statistics
+import psycopg2
+
+from vector_storage import (
+    VECTOR_DIMENSION, STORAGE_MODES, create_index_sql, index_name, search_sql
+)
+from curriculum import COURSE_SLUGS
+
+DATABASE_URL = os.environ.get('DATABASE_URL')
+TABLES = ("teaching_materials", "physics_vectors")
+
+def get_db_connection():
+    """連接到您的 Postgres (Neon) 資料庫"""
+    try:
+        conn = psycopg2.connect(DATABASE_URL)
+        return conn
+    except Exception as e:
+        print(f"!!! 嚴重錯誤：無法連接到資料庫。錯誤：{e}")
+        return None
+
+def table_exists(cur, table):
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL", (table,))
+    return cur.fetchone()[0]
+
+def build_index(conn, table, mode, dim):
+    print(f"--- (SQL) 正在建立索引 {index_name(table, mode, dim)} (CONCURRENTLY)... ---")
+    started = time.perf_counter()
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute(create_index_sql(table, mode, dim, concurrently=True))
+        cur.execute("SELECT pg_size_pretty(pg_relation_size(%s))", (index_name(table, mode, dim),))
+        size = cur.fetchone()[0]
+    conn.autocommit = False
+    print(f"--- (SQL) 索引完成，耗時 {time.perf_counter() - started:.1f} 秒，大小 {size} ---")
+
+def course_index_name(table, mode, dim, course):
+    return index_name(table, mode, dim).replace("_idx", f"_{COURSE_SLUGS[course]}_idx")
+
+def table_courses(cur, table):
+    cur.execute("""
+        SELECT 1 FROM information_schema.columns WHERE table_name = %s AND column_name = 'course'
+    """, (table,))
+    if not cur.fetchone():
+        return []
+    cur.execute(f"SELECT DISTINCT course FROM {table} WHERE course IS NOT NULL")
+    return [row[0] for row in cur.fetchall() if row[0] in COURSE_SLUGS]
+
+def build_course_indexes(conn, table, mode, dim):
+    """每個課程一個部分索引，過濾課程時只掃描該課程的向量"""
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        for course in table_courses(cur, table):
+            name = course_index_name(table, mode, dim, course)
+            print(f"--- (SQL) 正在建立課程部分索引 {name} ({course})... ---")
+            cur.execute(create_index_sql(
+                table, mode, dim, concurrently=True,
+                where=f"course = '{course}'", name=name
+            ))
+    conn.autocommit = False
+
+def drop_index(conn, table, mode, dim):
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        names = [index_name(table, mode, dim)]
+        names += [course_index_name(table, mode, dim, c) for c in table_courses(cur, table)]
+        for name in names:
+            cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+            print(f"--- (SQL) 已移除索引 {name} ---")
+    conn.autocommit = False
+
+def sample_queries(cur, table, n):
+    """回傳 [(id, 向量文字), ...]"""
+    cur.execute(f"SELECT id, embedding::text FROM {table} ORDER BY random() LIMIT %s", (n,))
+    return cur.fetchall()
+
+def run_query(cur, sql, params, force_exact=False):
+    cur.execute("BEGIN")
+    if force_exact:
+        # 強制循序掃描，取得完整精度的「標準答案」
+        cur.execute("SET LOCAL enable_indexscan = off")
+    cur.execute(f"SET LOCAL hnsw.ef_search = {max(40, params['candidates'])}")
+    started = time.perf_counter()
+    cur.execute(sql, params)
+    ids = [row[0] for row in cur.fetchall()]
+    elapsed = (time.perf_counter() - started) * 1000
+    cur.execute("COMMIT")
+    return ids, elapsed
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+def benchmark(conn, table, mode, dim, k, candidates, n_queries):
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        queries = sample_queries(cur, table, n_queries)
+        if not queries:
+            print(f"!!! 警告：'{table}' 沒有資料，略過基準測試。")
+            return
+        exact_sql = search_sql(table, ("id",), "full", VECTOR_DIMENSION)
+        compact_sql = search_sql(table, ("id",), mode, dim)
+
+        recalls, exact_ms, compact_ms = [], [], []
+        for query_id, vec in queries:
+            # 多取一筆，扣掉查詢向量自己那一列
+            params = {"vec": vec, "candidates": max(candidates, k + 1), "top_k": k + 1}
+            truth, t_exact = run_query(cur, exact_sql, params, force_exact=True)
+            found, t_compact = run_query(cur, compact_sql, params)
+            truth = [i for i in truth if i != query_id][:k]
+            found = [i for i in found if i != query_id][:k]
+            recalls.append(len(set(truth) & set(found)) / max(1, len(truth)))
+            exact_ms.append(t_exact)
+            compact_ms.append(t_compact)
+    conn.autocommit = False
+
+    print(f"\n--- (基準測試) {table}：{len(queries)} 筆查詢，k={k}，候選數={candidates} ---")
+    print(f"  {'設定':<24}{'recall@' + str(k):>12}{'p50 (ms)':>12}{'p95 (ms)':>12}")
+    print(f"  {'full 暴力搜尋 (基準)':<24}{1.0:>12.3f}{statistics.median(exact_ms):>12.1f}{percentile(exact_ms, 95):>12.1f}")
+    label = f"{mode}/{dim} + rerank"
+    print(f"  {label:<24}{statistics.mean(recalls):>12.3f}{statistics.median(compact_ms):>12.1f}{percentile(compact_ms, 95):>12.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="壓縮向量索引遷移與基準測試")
+    parser.add_argument("--mode", choices=STORAGE_MODES, default="halfvec")
+    parser.add_argument("--dim", type=int, default=VECTOR_DIMENSION, help="第一階段使用的維度 (Matryoshka 截斷)")
+    parser.add_argument("--tables", nargs="+", default=list(TABLES))
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--candidates", type=int, default=40, help="粗篩候選數 (精確重排序前)")
+    parser.add_argument("--queries", type=int, default=50, help="基準測試抽樣查詢數")
+    parser.add_argument("--benchmark-only", action="store_true", help="不建立索引，只跑基準測試")
+    parser.add_argument("--drop", action="store_true", help="移除此模式的索引 (回復)")
+    parser.add_argument("--no-course-indexes", action="store_true", help="不建立各課程的部分索引")
+    args = parser.parse_args()
+
+    if not DATABASE_URL:
+        print("錯誤：DATABASE_URL 環境變數未設定！")
+        sys.exit(1)
+
+    conn = get_db_connection()
+    if not conn:
+        sys.exit(1)
+
+    try:
+        with conn.cursor() as cur:
+            tables = [t for t in args.tables if table_exists(cur, t)]
+        conn.commit()
+
+        for table in tables:
+            if args.drop:
+                drop_index(conn, table, args.mode, args.dim)
+                continue
+            if not args.benchmark_only:
+                build_index(conn, table, args.mode, args.dim)
+                if not args.no_course_indexes:
+                    build_course_indexes(conn, table, args.mode, args.dim)
+            benchmark(conn, table, args.mode, args.dim, args.k, args.candidates, args.queries)
+
+        if not args.drop:
+            print("\n★★★ 完成！確認召回率可接受後，請在環境變數設定：")
+            print(f"VECTOR_STORAGE={args.mode}")
+            print(f"COMPACT_DIMENSION={args.dim}")
+            print(f"RERANK_CANDIDATES={args.candidates}")
+    except Exception as e:
+        print(f"\n!!! 嚴重錯誤：遷移過程失敗。錯誤：{e}")
+        sys.exit(1)
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    main()
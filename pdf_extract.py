@@ -0,0 +1,118 @@
+# 檔案：pdf_extract.py
+#
+# 共用的 PDF 逐頁文字擷取 + 磁碟快取。
+# rebuild_database.py / upload_vectors.py (PyMuPDF) 與 main.py 背景讀書 (pypdf)
+# 原本每次執行都重新解析同一批大型 PDF；這裡把每頁文字快取在磁碟上。
+#
+# 快取 key = 檔案內容 SHA-256 + 擷取器名稱 + 擷取器版本 + 快取格式版本，
+# 檔案內容一改變 key 就不同，自然失效；升級 PyMuPDF / pypdf 也會重新擷取。
+# 快取檔為 gzip 壓縮的 JSON Lines (一頁一行)，讀取時逐行產生，不會整份載入記憶體。
+# 只有每一頁都擷取成功才寫入快取，暫時性或解析器的錯誤不會變成永久的空白頁。
+
+import os
+import gzip
+import json
+import hashlib
+import tempfile
+
+EXTRACT_CACHE_DIR = os.environ.get('EXTRACT_CACHE_DIR', '.extract_cache')
+CACHE_FORMAT_VERSION = 1
+EXTRACTORS = ("pymupdf", "pypdf")
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+class PageExtractionError(Exception):
+    """某一頁擷取失敗 (skip_failed_pages=False 時拋出)"""
+
+def _extractor_version(extractor):
+    if extractor == "pymupdf":
+        import fitz
+        return fitz.VersionBind
+    if extractor == "pypdf":
+        import pypdf
+        return pypdf.__version__
+    raise ValueError(f"未知的擷取器: {extractor} (可用: {', '.join(EXTRACTORS)})")
+
+def _iter_raw_pages(path, extractor):
+    """直接解析 PDF，逐頁產生 (文字, 是否成功)；失敗的頁面文字為空字串"""
+    if extractor == "pymupdf":
+        import fitz  # 這就是 PyMuPDF
+        with fitz.open(path) as doc:
+            for page in doc:
+                yield page.get_text("text"), True
+    else:
+        from pypdf import PdfReader
+        reader = PdfReader(path)
+        for page_num, page in enumerate(reader.pages, 1):
+            try:
+                text = page.extract_text() or ""
+            except Exception as e:
+                print(f"⚠️ {os.path.basename(path)} 第 {page_num} 頁解析失敗: {e}")
+                yield "", False
+                continue
+            yield text, True
+
+def _iter_checked_pages(path, extractor, skip_failed_pages):
+    """逐頁產生 (頁碼, 文字, 是否成功)；skip_failed_pages=False 時遇到失敗頁面直接拋出"""
+    for page_num, (text, ok) in enumerate(_iter_raw_pages(path, extractor), 1):
+        if not ok and not skip_failed_pages:
+            raise PageExtractionError(f"{os.path.basename(path)} 第 {page_num} 頁擷取失敗")
+        yield page_num, text.replace('\x00', ''), ok
+
+def cache_path(path, extractor):
+    version = _extractor_version(extractor)
+    return os.path.join(
+        EXTRACT_CACHE_DIR,
+        f"{file_sha256(path)}-{extractor}-{version}-v{CACHE_FORMAT_VERSION}.jsonl.gz"
+    )
+
+def extract_pages(path, extractor="pymupdf", use_cache=True, skip_failed_pages=True):
+    """
+    逐頁產生 (頁碼, 文字)，頁碼從 1 開始，已移除 NUL 字元。
+    有快取就直接讀快取；沒有就解析 PDF，完整讀完且沒有失敗頁面才寫入快取 (中途中斷不會留下半份快取)。
+    skip_failed_pages=False 時，任何一頁擷取失敗都會拋出 PageExtractionError。
+    """
+    cached = cache_path(path, extractor) if use_cache else None
+    if cached and os.path.exists(cached):
+        with gzip.open(cached, 'rt', encoding='utf-8') as f:
+            for line in f:
+                page = json.loads(line)
+                yield page["page"], page["text"]
+        return
+
+    if not cached:
+        for page_num, text, _ in _iter_checked_pages(path, extractor, skip_failed_pages):
+            yield page_num, text
+        return
+
+    os.makedirs(EXTRACT_CACHE_DIR, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=EXTRACT_CACHE_DIR, suffix=".tmp")
+    complete = True
+    try:
+        with os.fdopen(fd, 'wb') as raw, gzip.open(raw, 'wt', encoding='utf-8') as f:
+            for page_num, text, ok in _iter_checked_pages(path, extractor, skip_failed_pages):
+                complete = complete and ok
+                f.write(json.dumps({"page": page_num, "text": text}, ensure_ascii=False) + "\n")
+                yield page_num, text
+        if complete:
+            os.replace(temp_path, cached)
+        else:
+            print(f"⚠️ {os.path.basename(path)} 有頁面擷取失敗，不寫入快取 (下次重新擷取)")
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def ensure_extracted(path, extractor="pymupdf", skip_failed_pages=True):
+    """
+    先把整份 PDF 擷取完並寫入快取 (已有快取則直接略過)，回傳頁數；不在記憶體保留頁面文字。
+    之後的 extract_pages 就只讀快取，不會在逐頁處理的中途才遇到擷取失敗。
+    """
+    page_count = 0
+    for _ in extract_pages(path, extractor, skip_failed_pages=skip_failed_pages):
+        page_count += 1
+    return page_count
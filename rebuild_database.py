@@ -10,8 +10,9 @@ from pgvector.psycopg2 import register_vector
 from google import genai
 from google.genai import types
 from pathlib import Path
-import fitz  # 這就是 PyMuPDF
+from pdf_extract import extract_pages  # (PyMuPDF 擷取 + 磁碟快取)
 import time  # ★ (新功能) 引入 time 模組來控制延遲
+from curriculum import parse_curriculum_metadata
 
 # --- ★ 步驟一：讀取環境變數 (與 main.py 相同) ★ ---
 try:
@@ -45,6 +46,7 @@ def get_db_connection():
 def load_documents_from_corpus(corpus_dir_path):
     """
     自動從 corpus 資料夾加載所有 .pdf, .txt, .md 檔案。
+    回傳 [(片段內容, 檔名, 頁碼), ...]；TXT/MD 沒有頁碼 (None)。
     """
     p = Path(corpus_dir_path)
     if not p.is_dir():
@@ -59,13 +61,12 @@ def load_documents_from_corpus(corpus_dir_path):
         if file_path.suffix == ".pdf":
             try:
                 print(f"  正在處理 PDF: {file_path.name} ...")
-                doc = fitz.open(file_path)
-                for page_num, page in enumerate(doc):
-                    text = page.get_text("text").strip() 
+                # ★ 逐頁文字有磁碟快取 (pdf_extract.py)，PDF 沒改過就不會重新解析
+                for page_num, page_text in extract_pages(file_path, extractor="pymupdf"):
+                    text = page_text.strip()
                     if text:
-                        source_info = f"來源：{file_path.name} (第 {page_num + 1} 頁)"
-                        chunks.append(f"{source_info}\n\n{text}")
-                doc.close()
+                        source_info = f"來源：{file_path.name} (第 {page_num} 頁)"
+                        chunks.append((f"{source_info}\n\n{text}", file_path.name, page_num))
             except Exception as e:
                 print(f"!!! 警告：處理 PDF '{file_path.name}' 失敗。錯誤：{e}")
 
@@ -78,7 +79,7 @@ def load_documents_from_corpus(corpus_dir_path):
                     cleaned_para = para.strip()
                     if cleaned_para:
                         source_info = f"來源：{file_path.name}"
-                        chunks.append(f"{source_info}\n\n{cleaned_para}")
+                        chunks.append((f"{source_info}\n\n{cleaned_para}", file_path.name, None))
             except Exception as e:
                 print(f"!!! 警告：處理 TXT/MD '{file_path.name}' 失敗。錯誤：{e}")
                 
@@ -114,12 +115,24 @@ def main():
             
             print("--- (SQL) 正在清空 'physics_vectors' 表格中的舊資料... ---")
             cur.execute("TRUNCATE TABLE physics_vectors RESTART IDENTITY;")
+            # ★ 課程結構欄位 (舊表格自動補上)
+            cur.execute("""
+                ALTER TABLE physics_vectors
+                    ADD COLUMN IF NOT EXISTS filename TEXT,
+                    ADD COLUMN IF NOT EXISTS course TEXT,
+                    ADD COLUMN IF NOT EXISTS chapter INTEGER,
+                    ADD COLUMN IF NOT EXISTS doc_type TEXT,
+                    ADD COLUMN IF NOT EXISTS page INTEGER;
+            """)
+            cur.execute("CREATE INDEX IF NOT EXISTS physics_vectors_course_chapter_idx ON physics_vectors (course, chapter);")
+            cur.execute("CREATE INDEX IF NOT EXISTS physics_vectors_doc_type_idx ON physics_vectors (doc_type);")
             print("--- (SQL) 舊資料已清空 ---")
 
             print(f"--- (RAG) 即將開始為 {total_chunks} 個片段產生 {VECTOR_DIMENSION} 維向量... ---")
             print(f"--- (RAG) 由於已啟用 {REQUEST_DELAY} 秒延遲，預計總耗時約 { (total_chunks * REQUEST_DELAY / 60):.1f} 分鐘... ---")
 
-            for i, chunk_content_raw in enumerate(chunks_to_process):
+            for i, (chunk_content_raw, filename, page) in enumerate(chunks_to_process):
+                meta = parse_curriculum_metadata(filename)
                 
                 # (1) 清理 NUL (0x00) 字元
                 chunk_content = chunk_content_raw.replace('\x00', '')
@@ -161,8 +174,9 @@ def main():
                 # (2) 存入資料庫 (僅在重試成功後)
                 if embedding_vector:
                     cur.execute(
-                        "INSERT INTO physics_vectors (content, embedding) VALUES (%s, %s)",
-                        (chunk_content, embedding_vector)
+                        """INSERT INTO physics_vectors (content, embedding, filename, course, chapter, doc_type, page)
+                           VALUES (%s, %s, %s, %s, %s, %s, %s)""",
+                        (chunk_content, embedding_vector, filename, meta["course"], meta["chapter"], meta["doc_type"], page)
                     )
                 else:
                     # (理論上 'raise e' 會阻止程式跑到這裡，但作為保險)
@@ -1,5 +1,5 @@
 import os
-import fitz  # PyMuPDF
+from pdf_extract import extract_pages  # PyMuPDF 擷取 + 磁碟快取
 import psycopg2
 from pgvector.psycopg2 import register_vector
 # ★ 移除了 import SentenceTransformer ★
@@ -7,6 +7,7 @@ import google.generativeai as genai # ★ 改用 Gemini！
 import json
 import sys
 import time # ★ 引入 time 模組來處理 API 速率
+from curriculum import parse_curriculum_metadata
 
 # --- ★★★【請您手動修改這裡 (2 個)】★★★ ---
 #
@@ -35,24 +36,26 @@ def get_db_connection():
         return None
 
 def read_pdfs_from_corpus():
-    """從 'corpus' 資料夾讀取所有 PDF 並提取文字 (★ 已修復 NUL 錯誤 ★)"""
+    """
+    從 'corpus' 資料夾讀取所有 PDF 並提取文字 (★ 已修復 NUL 錯誤 ★)
+    回傳 [(檔名, 頁碼, 文字), ...]，保留來源以便寫入課程結構欄位；TXT 頁碼為 None。
+    """
     print(f"--- (RAG) 正在從 'corpus' 資料夾讀取所有 PDF... ---")
-    corpus_text = ""
+    pages = []
     corpus_dir = 'corpus'
 
     if not os.path.exists(corpus_dir):
         print(f"!!! (RAG) 錯誤：找不到 '{corpus_dir}' 資料夾！")
-        return ""
+        return []
 
     for filename in os.listdir(corpus_dir):
         if filename.endswith('.pdf'):
             filepath = os.path.join(corpus_dir, filename)
             print(f"  > (RAG) 正在讀取 PDF: {filename}")
             try:
-                with fitz.open(filepath) as doc:
-                    for page in doc:
-                        clean_text = page.get_text().replace('\x00', '')
-                        corpus_text += clean_text + "\n\n"
+                # ★ 逐頁文字有磁碟快取 (pdf_extract.py)，已清除 NUL
+                for page_num, clean_text in extract_pages(filepath, extractor="pymupdf"):
+                    pages.append((filename, page_num, clean_text + "\n\n"))
             except Exception as pdf_e:
                 print(f"!!! (RAG) 錯誤：讀取 PDF '{filename}' 失敗。錯誤：{pdf_e}")
 
@@ -62,16 +65,15 @@ def read_pdfs_from_corpus():
             try:
                 with open(filepath, 'r', encoding='utf-8') as f:
                     clean_text = f.read().replace('\x00', '')
-                    corpus_text += clean_text + "\n\n"
+                    pages.append((filename, None, clean_text + "\n\n"))
             except Exception as txt_e:
                 print(f"!!! (RAG) 錯誤：讀取 TXT '{filename}' 失敗。錯誤：{txt_e}")
 
-    print(f"--- (RAG) 所有 PDF 讀取完畢。總共 {len(corpus_text)} 字元 (已清洗) ---")
-    return corpus_text
+    print(f"--- (RAG) 所有 PDF 讀取完畢。總共 {sum(len(p[2]) for p in pages)} 字元 (已清洗) ---")
+    return pages
 
 def chunk_text(text, chunk_size=1000, overlap=200):
     """將長文本切割成帶有重疊的段落 (Chunk)"""
-    print(f"--- (RAG) 正在將 {len(text)} 字元的文本切割成段落... ---")
     chunks = []
     start = 0
     while start < len(text):
@@ -84,7 +86,6 @@ def chunk_text(text, chunk_size=1000, overlap=200):
     if end < len(text) and start <= len(text):
          chunks.append(text[start:])
 
-    print(f"--- (RAG) 文本切割完畢，共產生 {len(chunks)} 個段落 (Chunks) ---")
     return chunks
 
 def main():
@@ -105,12 +106,21 @@ def main():
     # --- ★★★【步驟一：本地處理 (慢速)】★★★
     try:
         print("--- (本地) 步驟 1/4：讀取並切割 PDF... ---")
-        full_text = read_pdfs_from_corpus()
-        if not full_text:
+        pages = read_pdfs_from_corpus()
+        if not pages:
             print("!!! (RAG) 沒有讀取到任何文字，程式終止。")
             sys.exit(1)
 
-        chunks = chunk_text(full_text)
+        # 逐頁切割，讓每個段落都帶著「檔名 / 頁碼」
+        sources = []
+        chunks = []
+        for filename, page_num, text in pages:
+            if not text.strip():
+                continue
+            for chunk in chunk_text(text):
+                chunks.append(chunk)
+                sources.append((filename, page_num))
+        print(f"--- (RAG) 文本切割完畢，共產生 {len(chunks)} 個段落 (Chunks) ---")
         if not chunks:
             print("!!! (RAG) 沒有產生任何文字段落，程式終止。")
             sys.exit(1)
@@ -186,18 +196,28 @@ def main():
                 CREATE TABLE IF NOT EXISTS physics_vectors (
                     id SERIAL PRIMARY KEY,
                     content TEXT,
-                    embedding VECTOR({VECTOR_DIMENSION})
+                    embedding VECTOR({VECTOR_DIMENSION}),
+                    filename TEXT,
+                    course TEXT,
+                    chapter INTEGER,
+                    doc_type TEXT,
+                    page INTEGER
                 );
             """)
+            cur.execute("CREATE INDEX IF NOT EXISTS physics_vectors_course_chapter_idx ON physics_vectors (course, chapter);")
+            cur.execute("CREATE INDEX IF NOT EXISTS physics_vectors_doc_type_idx ON physics_vectors (doc_type);")
             print(f"--- (SQL) ★ 新的 `physics_vectors` 表格 (維度 {VECTOR_DIMENSION}) 已確認/建立 ★ ---")
 
             print("--- (SQL) 正在將資料「高速」上傳到 Neon 資料庫... ---")
             for i in range(len(embeddings)):
                 content = chunks[i] # 確保 chunks 和 embeddings 索引一致
                 embedding = embeddings[i]
+                filename, page_num = sources[i]
+                meta = parse_curriculum_metadata(filename)
                 cur.execute(
-                    "INSERT INTO physics_vectors (content, embedding) VALUES (%s, %s)",
-                    (content, embedding)
+                    """INSERT INTO physics_vectors (content, embedding, filename, course, chapter, doc_type, page)
+                       VALUES (%s, %s, %s, %s, %s, %s, %s)""",
+                    (content, embedding, filename, meta["course"], meta["chapter"], meta["doc_type"], page_num)
                 )
 
             conn.commit()
@@ -0,0 +1,131 @@
+# 檔案：vector_storage.py
+#
+# 向量儲存模式 (完整精度 / halfvec / 二元量化) 的 SQL 組裝與教材檢索查詢。
+# main.py、async_app.py、migrate_vector_storage.py、evaluate_retrieval.py 共用，
+# 匯入時沒有任何副作用 (不連資料庫、不需要 LINE / Gemini 金鑰)。
+# 「建索引」與「查詢」使用同一組運算式，確保完全一致
+# (pgvector 只有在 ORDER BY 的運算式與索引運算式相同時才會使用該索引)。
+#
+# 做法：資料表仍保留完整的 vector(768) 欄位作為精確重排序 (rerank) 的依據，
+# 第一階段搜尋則走「壓縮運算式索引」：
+#   - halfvec : embedding::halfvec(N)                 (索引記憶體減半)
+#   - binary  : binary_quantize(embedding)::bit(N)    (索引記憶體約 1/32，以 Hamming 距離粗篩)
+# N < 768 時先取 subvector(embedding, 1, N)。text-embedding-004 的 output_dimensionality
+# 就是截斷同一條 Matryoshka 向量，因此直接截斷已存的 768 維向量即可，不需重新呼叫 API；
+# cosine 距離與向量長度無關，截斷後不必重新正規化。
+
+import os
+
+import psycopg2
+
+VECTOR_DIMENSION = 768
+STORAGE_MODES = ("full", "halfvec", "binary")
+
+VECTOR_STORAGE = os.environ.get('VECTOR_STORAGE', 'full')
+COMPACT_DIMENSION = int(os.environ.get('COMPACT_DIMENSION', VECTOR_DIMENSION))
+RERANK_CANDIDATES = int(os.environ.get('RERANK_CANDIDATES', 40))
+
+_OPCLASSES = {
+    "full": "vector_cosine_ops",
+    "halfvec": "halfvec_cosine_ops",
+    "binary": "bit_hamming_ops",
+}
+
+def _check(mode, dim):
+    if mode not in STORAGE_MODES:
+        raise ValueError(f"未知的 VECTOR_STORAGE: {mode} (可用: {', '.join(STORAGE_MODES)})")
+    if not 1 <= dim <= VECTOR_DIMENSION:
+        raise ValueError(f"COMPACT_DIMENSION 必須介於 1 與 {VECTOR_DIMENSION} 之間: {dim}")
+
+def compact_expression(vector_sql, mode=VECTOR_STORAGE, dim=COMPACT_DIMENSION):
+    """回傳第一階段搜尋使用的 SQL 運算式 (vector_sql 可以是欄位名稱或參數)"""
+    _check(mode, dim)
+    if dim < VECTOR_DIMENSION:
+        vector_sql = f"subvector({vector_sql}, 1, {dim})"
+    if mode == "halfvec":
+        return f"({vector_sql})::halfvec({dim})"
+    if mode == "binary":
+        return f"binary_quantize({vector_sql})::bit({dim})"
+    if dim < VECTOR_DIMENSION:
+        return f"({vector_sql})::vector({dim})"
+    return vector_sql
+
+def distance_operator(mode=VECTOR_STORAGE):
+    return "<~>" if mode == "binary" else "<=>"
+
+def index_name(table, mode=VECTOR_STORAGE, dim=COMPACT_DIMENSION):
+    return f"{table}_embedding_{mode}_{dim}_idx"
+
+def create_index_sql(table, mode=VECTOR_STORAGE, dim=COMPACT_DIMENSION, concurrently=False, where=None, name=None):
+    """建立第一階段搜尋用的 HNSW 運算式索引"""
+    expr = compact_expression("embedding", mode, dim)
+    sql = (
+        f"CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}IF NOT EXISTS {name or index_name(table, mode, dim)} "
+        f"ON {table} USING hnsw (({expr}) {_OPCLASSES[mode]})"
+    )
+    if where:
+        sql += f" WHERE {where}"
+    return sql
+
+def search_sql(table, columns, mode=VECTOR_STORAGE, dim=COMPACT_DIMENSION, where=None):
+    """
+    組出「壓縮向量粗篩 + 完整向量精確重排序」的查詢。
+    參數使用具名格式：%(vec)s、%(candidates)s、%(top_k)s。
+    完整精度且未降維時不需要重排序，直接回傳單層查詢。
+    """
+    cols = ", ".join(columns)
+    where_sql = f"WHERE {where}" if where else ""
+    exact = "embedding <=> %(vec)s::vector"
+    if mode == "full" and dim == VECTOR_DIMENSION:
+        return f"SELECT {cols} FROM {table} {where_sql} ORDER BY {exact} LIMIT %(top_k)s"
+
+    first_pass = (
+        f"{compact_expression('embedding', mode, dim)} {distance_operator(mode)} "
+        f"{compact_expression('%(vec)s::vector', mode, dim)}"
+    )
+    return f"""
+        SELECT {cols} FROM (
+            SELECT {cols}, embedding FROM {table} {where_sql}
+            ORDER BY {first_pass} LIMIT %(candidates)s
+        ) AS candidates
+        ORDER BY {exact} LIMIT %(top_k)s
+    """
+
+# ==========================================
+# 教材檢索查詢
+# ==========================================
+SEARCH_FILTERS = ("course", "chapter", "doc_type")
+
+# pgvector 0.8+：過濾後結果不足時繼續掃描 HNSW，避免回傳少於 top_k 筆
+ITERATIVE_SCAN_SQL = "SET LOCAL hnsw.iterative_scan = relaxed_order"
+
+def build_search_query(vec, top_k=3, mode=VECTOR_STORAGE, dim=COMPACT_DIMENSION, candidates=RERANK_CANDIDATES, filters=None):
+    """
+    組出教材檢索查詢，回傳 (session 設定語句, SQL, 參數)；同步與非同步連線共用。
+    filters 可指定 course / chapter / doc_type，只在符合的教材中搜尋 (可使用各課程的部分索引)。
+    """
+    filters = {k: v for k, v in (filters or {}).items() if k in SEARCH_FILTERS and v is not None}
+    where = " AND ".join(f"{k} = %({k})s" for k in filters) or None
+    settings = []
+    if mode != "full" or dim != VECTOR_DIMENSION:
+        # HNSW 預設只回傳 ef_search (40) 筆，粗篩候選數需同步放大
+        settings.append(f"SET LOCAL hnsw.ef_search = {max(40, int(candidates))}")
+    sql = search_sql("teaching_materials", ("content", "filename", "page"), mode, dim, where=where)
+    params = {"vec": vec, "candidates": max(int(candidates), top_k), "top_k": top_k, **filters}
+    return settings, sql, params
+
+def run_search(conn, vec, top_k=3, mode=VECTOR_STORAGE, dim=COMPACT_DIMENSION, candidates=RERANK_CANDIDATES, filters=None):
+    """在 psycopg2 連線上執行教材檢索，回傳 [(content, filename, page), ...]"""
+    settings, sql, params = build_search_query(vec, top_k, mode, dim, candidates, filters)
+    cur = conn.cursor()
+    if filters:
+        try:
+            cur.execute(ITERATIVE_SCAN_SQL)
+        except psycopg2.Error:
+            conn.rollback()
+    for statement in settings:
+        cur.execute(statement)
+    cur.execute(sql, params)
+    rows = cur.fetchall()
+    cur.close()
+    return rows